@@ -0,0 +1,92 @@
+# Builds the markov chains of characters ahead of time for the south park
+# chatbot, in a pool of worker processes across all cores, so the first
+# request for a character does not have to wait for a full nlp parse of
+# its quotes. the workers hand the chains back as snapshot bytes, which
+# the chatbot uses in place (see TextMarkovChain.snapshotBytes)
+
+# ************************ IMPORTS ********************************
+
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import spacy
+
+from dbhelper import DBHelper
+from TextMarkovChain import TextMarkovChain
+
+# ************************ WORKER PROCESSES ****************************
+
+# set up once per worker process by initWorker
+workernlp = None # spacy pipeline of the worker
+workerdb = None # quotes database connection of the worker
+
+def initWorker(qdbname, nlpname):
+  # loads the nlp pipeline and opens the quotes database in a worker
+
+  global workernlp, workerdb
+  workernlp = spacy.load(nlpname) if nlpname is not None else None
+  workerdb = DBHelper(dbname=qdbname, readonly=True)
+
+def buildChain(char, depth):
+  # builds the chain of char's quotes in a worker, as snapshot bytes
+
+  model = TextMarkovChain(depth=depth,
+    rows=workerdb.iter_items(char), nlp=workernlp)
+  return model.snapshotBytes()
+
+class ChainPrebuilder():
+
+  # ************************ CONSTRUCTOR *****************************
+
+  def __init__(self, qdbname, chars, nlp = None, nlpname = 'en',
+    depth = 2, workers = None, ondone = None):
+    # starts building the chains of chars in worker processes
+    # and returns right away
+    # parameters:
+    #   - qdbname: name/path to the sqlite database with the quotes
+    #   - chars: the characters to build chains of, in this order
+    #   - nlp: spacy pipeline of this process, given to the built chains
+    #   - nlpname: name of the same pipeline, loaded by each worker
+    #     (None if the chains are built without nlp)
+    #   - depth: look-ahead depth of the chains
+    #   - workers: number of worker processes (default: one per core)
+    #   - ondone: function(char, chain) called with each built chain
+    # workers are spawned rather than forked, as this process may
+    # already be running threads
+
+    self.nlp = nlp
+    self.ondone = ondone
+    self.futures = {} # char -> future of its snapshot bytes
+    executor = ProcessPoolExecutor(max_workers = workers,
+      mp_context = multiprocessing.get_context('spawn'),
+      initializer = initWorker, initargs = (qdbname, nlpname))
+    for char in chars:
+      future = executor.submit(buildChain, char, depth)
+      self.futures[char] = future
+      future.add_done_callback(functools.partial(self.finished, char))
+    # lets the workers exit once all chains are built
+    executor.shutdown(wait = False)
+
+  # ************************ RESULTS *****************************
+
+  def finished(self, char, future):
+    # turns the snapshot bytes of a built chain into a chain again
+    # and passes it on to ondone
+
+    if future.cancelled():
+      return
+    try:
+      data = future.result()
+    except Exception as e:
+      print('ChainPrebuilder: building {0} failed: {1}'.format(char, e))
+      return
+    model = TextMarkovChain(snapshot = data, nlp = self.nlp)
+    if self.ondone is not None:
+      self.ondone(char, model)
+
+  def pending(self):
+    # the characters whose chains are still being built
+
+    return [char for char, future in self.futures.items()
+      if not future.done()]
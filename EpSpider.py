@@ -1,34 +1,118 @@
 
 import scrapy
-from bs4 import BeautifulSoup
+from twisted.internet.threads import deferToThread
+from PageStore import PageStore
 
-# spider for downloading the episode summaries and scripts 
-# to crawl the episode summaries, use the line:
+# spider for downloading the episode summaries and scripts
+# both are crawled in one run, from the lines:
 #   http://southpark.wikia.com/wiki/{0}
-# to crawl the episode scripts, use the line: 
 #   http://southpark.wikia.com/wiki/{0}/Script
+# the pages are kept compressed in a single-file PageStore archive
+# (pages.archive by default), under the keys summary/<title> and
+# script/<title>, from which the process<X>FromHTML scripts read them
+# pages that were crawled before are requested conditionally (with the
+# ETag and Last-Modified they were served with), so unchanged pages are
+# not downloaded again
+#
+# usage: scrapy runspider EpSpider.py
+# options (all optional):
+#   -a filename=titles.txt   the episode titles to crawl
+#   -a baseurl=http://...    the wiki to crawl, e.g. a local test server
+#   -a archive=pages.archive the archive to keep the pages in
+#   -s CONCURRENT_REQUESTS_PER_DOMAIN=4   parallel requests per host
+#   -s DOWNLOAD_DELAY=0.25   seconds between requests to the same host
+#   -s AUTOTHROTTLE_ENABLED=False   to not adapt the delay to the host
+
+class PageStorePipeline:
+    # writes the crawled pages to the spider's page archive
+    # on a thread, so the crawl does not wait on the disk
+
+    def process_item(self, item, spider):
+        d = deferToThread(spider.store.put, item['key'], item['body'],
+                          url=item['url'], etag=item['etag'],
+                          lastmodified=item['lastmodified'])
+        d.addCallback(lambda digest: self.stored(item, digest, spider))
+        return d
+
+    def stored(self, item, digest, spider):
+        spider.log('Saved page %s (%s)' % (item['key'], digest[:12]))
+        return {'key': item['key'], 'hash': digest}
+
+    def close_spider(self, spider):
+        spider.store.close()
 
 class EpSpider(scrapy.Spider):
     name = "episodeswiki"
     filename = 'titles.txt'
+    baseurl = 'http://southpark.wikia.com/wiki/'
+    archive = 'pages.archive'
+    # key prefix -> url of the page, relative to baseurl
+    kinds = {
+        'summary': '{0}',
+        'script': '{0}/Script',
+    }
+    custom_settings = {
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 4,
+        'DOWNLOAD_DELAY': 0.25,
+        'AUTOTHROTTLE_ENABLED': True,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 2.0,
+        'ITEM_PIPELINES': {PageStorePipeline: 300},
+    }
+
+    def __init__(self, filename=None, baseurl=None, archive=None,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.filename = filename or self.filename
+        self.baseurl = baseurl or self.baseurl
+        self.archive = archive or self.archive
+        self.store = PageStore(self.archive)
+
+    async def start(self):
+        # newer scrapy versions (2.13+) start the crawl from here
+        for request in self.start_requests():
+            yield request
 
     def start_requests(self):
-        filename = 'titles.txt'
         titles = []
-        with open(filename, 'r') as f:
+        with open(self.filename, 'r') as f:
           for line in f:
-            titles.append(line.replace('\n','').replace('\'','%27')) 
-        urls = [
-            'http://southpark.wikia.com/wiki/{0}'.format(t) for t in titles
-            #'http://southpark.wikia.com/wiki/{0}/Script'.format(t) for t in titles
-        ]
-        for url in urls:
-            yield scrapy.Request(url=url, callback=self.parse)
+            titles.append(line.replace('\n',''))
+        for t in titles:
+            for kind, path in self.kinds.items():
+                key = '{0}/{1}'.format(kind, t)
+                url = self.baseurl + path.format(t.replace('\'','%27'))
+                yield scrapy.Request(url=url, callback=self.parse,
+                                     headers=self.conditional_headers(key),
+                                     meta={'key': key,
+                                           'handle_httpstatus_list': [304]})
 
+    def conditional_headers(self, key):
+        # validators of the stored page of key, if we have it
+        headers = {}
+        meta = self.store.meta(key)
+        if meta is not None:
+            if meta['etag']:
+                headers['If-None-Match'] = meta['etag']
+            if meta['lastmodified']:
+                headers['If-Modified-Since'] = meta['lastmodified']
+        return headers
 
     def parse(self, response):
-        page = response.url.split("/")[-1]
-        filename = 'episodes-%s.html' % page
-        with open(filename, 'wb') as f:
-            f.write(response.body)
-        self.log('Saved file %s' % filename)
+        key = response.meta['key']
+        if response.status == 304:
+            self.store.touch(key)
+            self.crawler.stats.inc_value('pagestore/unchanged')
+            self.log('Unchanged page %s' % key)
+            return
+        self.crawler.stats.inc_value('pagestore/changed')
+        yield {
+            'key': key,
+            'url': response.url,
+            'body': response.body,
+            'etag': self.header(response, 'ETag'),
+            'lastmodified': self.header(response, 'Last-Modified'),
+        }
+
+    def header(self, response, name):
+        value = response.headers.get(name)
+        return None if value is None else value.decode('latin-1')
@@ -0,0 +1,84 @@
+# Word vector based intent classifier for the south park chatbot
+# every keyphrase of every query is embedded once, as the normalized
+# mean of its word vectors, into one matrix. a message is then scored
+# against all keyphrases with a single matrix-vector product, so fuzzy
+# intent detection costs no spacy similarity calls per message
+
+# ************************ IMPORTS ********************************
+
+import numpy as np
+
+class IntentClassifier():
+
+  # ************************ CONSTRUCTOR *****************************
+
+  def __init__(self, vocab, queryphrases, margin = 0.05):
+    # embeds all keyphrases in queryphrases
+    # parameters:
+    #   - vocab: spacy vocab to look up word vectors in (nlp.vocab)
+    #   - queryphrases: dict of intent -> list of keyphrases, as in
+    #     MyModel.queryphrases
+    #   - margin: the best intent must score at least this much higher
+    #     than the runner-up to count as a match
+    # keyphrases without any word vector (such as commands) are left out
+
+    self.vocab = vocab
+    self.margin = margin
+    self.intents = [] # intent names, in the order of their matrix rows
+    self.starts = [] # first row of each intent in self.matrix
+    rows = []
+    for intent, phrases in queryphrases.items():
+      vectors = [v for v in (self.embed(p.split()) for p in phrases)
+        if v is not None]
+      if len(vectors) > 0:
+        self.intents.append(intent)
+        self.starts.append(len(rows))
+        rows.extend(vectors)
+    self.dim = len(rows[0]) if len(rows) > 0 else 0
+    self.matrix = np.array(rows, np.float32).reshape(len(rows), self.dim)
+    self.starts = np.array(self.starts, np.intp)
+
+  # ************************ EMBEDDING *****************************
+
+  def wordVector(self, word):
+    # the word vector of word, or None if it has none
+    # (Lexeme.vector raises on a pipeline without vectors, so the
+    # vectors table is asked directly)
+
+    if self.vocab.vectors_length == 0 or not self.vocab.has_vector(word):
+      return None
+    vector = self.vocab.get_vector(word)
+    return vector if vector.any() else None
+
+  def embed(self, words):
+    # normalized mean of the word vectors of words
+    # or None if none of the words has a word vector
+
+    vectors = [v for v in (self.wordVector(w.lower()) for w in words)
+      if v is not None]
+    if len(vectors) == 0:
+      return None
+    vector = np.mean(vectors, axis=0, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else None
+
+  # ************************ CLASSIFYING *****************************
+
+  def classify(self, words):
+    # scores the words of a message against all intents
+    # returns (intent, score) of the best scoring intent, with score the
+    # cosine similarity to its closest keyphrase, or None if there is no
+    # clear winner (no word vectors, or within margin of the runner-up)
+
+    if len(self.intents) == 0:
+      return None
+    vector = self.embed(words)
+    if vector is None or len(vector) != self.dim:
+      return None
+    scores = np.maximum.reduceat(self.matrix.dot(vector), self.starts)
+    best = int(np.argmax(scores))
+    if len(scores) > 1:
+      runnerup = np.max(np.delete(scores, best))
+      if scores[best] - runnerup < self.margin:
+        return None
+    return (self.intents[best], float(scores[best]))
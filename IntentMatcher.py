@@ -0,0 +1,101 @@
+# Compiled keyphrase matcher for the south park chatbot
+# all keyphrases of all queries are compiled into one aho-corasick
+# automaton, which finds every keyphrase in a text in a single pass,
+# instead of testing the keyphrases of each query one after another
+
+# ************************ IMPORTS ********************************
+
+from collections import deque
+
+class IntentMatcher():
+
+  # ************************ CONSTRUCTOR *****************************
+
+  def __init__(self, queryphrases = None):
+    # initializes the automaton with the keyphrases in queryphrases
+    # queryphrases: dict of intent -> list of keyphrases, as in
+    #   MyModel.queryphrases
+
+    self.goto = [{}] # state -> {character: next state}
+    self.fail = [0] # state -> state of its longest proper suffix
+    self.out = [[]] # state -> [(intent, keyphrase)] ending in state
+    self.compiled = True
+    if queryphrases is not None:
+      for intent, phrases in queryphrases.items():
+        for phrase in phrases:
+          self.add(intent, phrase)
+      self.compile()
+
+  # ************************ BUILDING *****************************
+
+  def add(self, intent, phrase):
+    # adds a keyphrase of intent to the trie
+    # compile() must be called before matching again
+
+    state = 0
+    for c in phrase:
+      nextstate = self.goto[state].get(c)
+      if nextstate is None:
+        nextstate = len(self.goto)
+        self.goto[state][c] = nextstate
+        self.goto.append({})
+        self.fail.append(0)
+        self.out.append([])
+      state = nextstate
+    if (intent, phrase) not in self.out[state]:
+      self.out[state].append((intent, phrase))
+    self.compiled = False
+
+  def compile(self):
+    # computes the failure links breadth-first, and merges the output of
+    # each state with that of its failure state, so matching only needs
+    # to look at the output of the state it is in
+
+    queue = deque()
+    for state in self.goto[0].values():
+      self.fail[state] = 0
+      queue.append(state)
+    while queue:
+      state = queue.popleft()
+      for c, nextstate in self.goto[state].items():
+        queue.append(nextstate)
+        f = self.fail[state]
+        while f and c not in self.goto[f]:
+          f = self.fail[f]
+        f = self.goto[f].get(c, 0)
+        self.fail[nextstate] = f if f != nextstate else 0
+        self.out[nextstate] = self.out[nextstate] + [
+          o for o in self.out[self.fail[nextstate]]
+          if o not in self.out[nextstate]]
+    self.compiled = True
+
+  # ************************ MATCHING *****************************
+
+  def findAll(self, text):
+    # returns all keyphrase occurrences in text, in order of where they end
+    # as a list of (intent, keyphrase, start, end), with text[start:end]
+    # being the keyphrase
+
+    if not self.compiled:
+      self.compile()
+    goto, fail, out = self.goto, self.fail, self.out
+    matches = []
+    state = 0
+    for i, c in enumerate(text):
+      while state and c not in goto[state]:
+        state = fail[state]
+      state = goto[state].get(c, 0)
+      for intent, phrase in out[state]:
+        matches.append((intent, phrase, i + 1 - len(phrase), i + 1))
+    return matches
+
+  def match(self, text):
+    # returns a dict of intent -> list of (start, end, keyphrase)
+    # of all keyphrases found in text, ordered by where they start
+
+    intents = {}
+    for intent, phrase, start, end in self.findAll(text):
+      intents.setdefault(intent, []).append((start, end, phrase))
+    for spans in intents.values():
+      spans.sort()
+    return intents
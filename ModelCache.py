@@ -0,0 +1,232 @@
+# Cache of markov chain models for the south park chatbot
+# keeps the chains of the most recently used keys (characters) in
+# memory, within a budget of bytes and/or entries. the least recently
+# used chains are evicted first, and can be spilled to snapshot files
+# instead of being dropped, so getting them back is a memory-map rather
+# than a rebuild
+
+# ************************ IMPORTS ********************************
+
+import os
+import glob
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from TextMarkovChain import TextMarkovChain
+
+SPILLSUFFIX = '.spill.tmc' # snapshot files of evicted chains
+
+class ModelCache():
+
+  # ************************ CONSTRUCTOR *****************************
+
+  def __init__(self, maxbytes = 0, maxentries = 0, spilldir = None,
+    nlp = None, onevict = None):
+    # initializes an empty cache
+    # parameters:
+    #   - maxbytes: budget for the estimated size of all cached chains
+    #     (see TextMarkovChain.footprint), 0 for no limit
+    #   - maxentries: maximum number of cached chains, 0 for no limit
+    #   - spilldir: if given, directory to write evicted chains to as
+    #     snapshots, which are loaded again on their next use
+    #     spill files left there by an earlier run are removed, as the
+    #     quotes may have changed since
+    #   - nlp: spacy pipeline the chains were built with, for reloading
+    #   - onevict: function(key) called after a chain was evicted,
+    #     e.g. to drop other references to it
+
+    self.maxbytes = maxbytes
+    self.maxentries = maxentries
+    self.spilldir = spilldir
+    self.nlp = nlp
+    self.onevict = onevict
+    self.models = OrderedDict() # key -> chain, least recently used first
+    self.sizes = {} # key -> estimated size of its chain in bytes
+    self.size = 0 # estimated size of all cached chains
+    self.spilled = set() # keys with an up to date spill file
+    self.building = {} # key -> future of its chain, while being built
+    self.lock = threading.RLock()
+    self.hits = 0 # chain was in memory
+    self.misses = 0 # chain had to be built or reloaded
+    self.spillhits = 0 # misses that reloaded a spill file
+    self.evictions = 0 # chains evicted
+    self.spills = 0 # evicted chains written to a spill file
+    self.joins = 0 # misses that waited for a build already running
+    if self.spilldir is not None:
+      os.makedirs(self.spilldir, exist_ok = True)
+      for filename in glob.glob(os.path.join(self.spilldir,
+        '*' + SPILLSUFFIX)):
+        os.remove(filename)
+
+  # ************************ LOOKUP *****************************
+
+  def __contains__(self, key):
+    return key in self.models
+
+  def __len__(self):
+    return len(self.models)
+
+  def peek(self, key):
+    # returns the cached chain of key, or None, without counting it as
+    # a use (and without reloading it from a spill file)
+
+    with self.lock:
+      return self.models.get(key)
+
+  def get(self, key, build):
+    # returns the chain of key, marking it as most recently used
+    # if it is not in memory, it is reloaded from its spill file or else
+    # built with build(), and then added, evicting others if needed
+    # only one build runs per key: callers that miss while it runs wait
+    # for it and get the same chain (or the same exception)
+
+    with self.lock:
+      model = self.models.get(key)
+      if model is not None:
+        self.models.move_to_end(key)
+        self.hits += 1
+        return model
+      self.misses += 1
+      future = self.building.get(key)
+      if future is not None:
+        self.joins += 1
+      else:
+        self.building[key] = Future()
+    if future is not None:
+      return future.result()
+
+    future = self.building[key]
+    try:
+      with self.lock:
+        model = self.loadSpill(key)
+      if model is None:
+        model = build()
+      model = self.put(key, model, replace = False)
+    except BaseException as e:
+      future.set_exception(e)
+      raise
+    else:
+      future.set_result(model)
+    finally:
+      with self.lock:
+        del self.building[key]
+    return model
+
+  def put(self, key, model, replace = True):
+    # adds (or replaces) the chain of key as most recently used
+    # and evicts the least recently used chains until within budget
+    # if replace is False, a chain that is already cached is kept
+    # returns the chain that is now cached under key
+
+    with self.lock:
+      if not replace and key in self.models:
+        return self.models[key]
+      if key in self.models:
+        self.size -= self.sizes[key]
+      self.models[key] = model
+      self.models.move_to_end(key)
+      self.sizes[key] = model.footprint()
+      self.size += self.sizes[key]
+      self.evict()
+      return model
+
+  def changed(self, key):
+    # to be called after the chain of key was updated: re-estimates its
+    # size and drops its spill file, which is out of date now
+
+    with self.lock:
+      self.dropSpill(key)
+      if key in self.models:
+        self.size -= self.sizes[key]
+        self.sizes[key] = self.models[key].footprint()
+        self.size += self.sizes[key]
+        self.evict()
+
+  def discard(self, key):
+    # forgets the chain of key, in memory as well as spilled
+
+    with self.lock:
+      self.dropSpill(key)
+      if key in self.models:
+        del self.models[key]
+        self.size -= self.sizes.pop(key)
+
+  # ************************ EVICTION *****************************
+
+  def overBudget(self):
+    return ((self.maxbytes > 0 and self.size > self.maxbytes) or
+      (self.maxentries > 0 and len(self.models) > self.maxentries))
+
+  def evict(self):
+    # evicts least recently used chains until the cache is within budget
+    # the most recently used chain always stays, even if it alone is
+    # over budget
+    # must be called while holding self.lock
+
+    while len(self.models) > 1 and self.overBudget():
+      key, model = self.models.popitem(last = False)
+      self.size -= self.sizes.pop(key)
+      self.evictions += 1
+      self.spill(key, model)
+      if self.onevict is not None:
+        self.onevict(key)
+
+  # ************************ SPILLING *****************************
+
+  def spillName(self, key):
+    # the spill file of key (keys may be any string, such as names)
+
+    name = hashlib.sha1(str(key).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(self.spilldir, name + SPILLSUFFIX)
+
+  def spill(self, key, model):
+    # writes an evicted chain to its spill file, unless spilling is off
+    # or the file is still up to date
+
+    if self.spilldir is None or key in self.spilled:
+      return
+    try:
+      model.saveSnapshot(self.spillName(key))
+      self.spilled.add(key)
+      self.spills += 1
+    except (OSError, ValueError) as e:
+      print('ModelCache: spilling {0} failed: {1}'.format(key, e))
+
+  def loadSpill(self, key):
+    # reloads the chain of key from its spill file, or returns None
+
+    if key not in self.spilled:
+      return None
+    model = TextMarkovChain(snapshot = self.spillName(key), nlp = self.nlp)
+    if model.snapshot is None: # could not be loaded after all
+      self.dropSpill(key)
+      return None
+    self.spillhits += 1
+    return model
+
+  def dropSpill(self, key):
+    if key in self.spilled:
+      self.spilled.discard(key)
+      try:
+        os.remove(self.spillName(key))
+      except OSError:
+        pass
+
+  # ************************ STATISTICS *****************************
+
+  def stats(self):
+    # the cache counters, and its current size in entries and bytes
+
+    with self.lock:
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'spillhits': self.spillhits,
+        'evictions': self.evictions,
+        'spills': self.spills,
+        'joins': self.joins,
+        'entries': len(self.models),
+        'bytes': self.size,
+      }
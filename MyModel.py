@@ -27,7 +27,9 @@
 
 from Model import Model
 from dbhelper import DBHelper
+import os
 import random
+import re
 import spacy
 import numpy as np
 from nltk.sentiment.vader import SentimentIntensityAnalyzer
@@ -36,6 +38,60 @@ from nltk.sentiment.vader import SentimentIntensityAnalyzer
 # Eighth International Conference on Weblogs and Social Media (ICWSM-14). 
 # Ann Arbor, MI, June 2014
 from TextMarkovChain import TextMarkovChain
+from ResponsePool import ResponsePool
+from ModelCache import ModelCache
+from ChainPrebuilder import ChainPrebuilder
+from IntentMatcher import IntentMatcher
+from IntentClassifier import IntentClassifier
+
+# ******************** MESSAGE CONTEXT ************************
+
+class MessageContext():
+  # everything the query handlers need to know about one message
+  # computed once per message and shared by all query handlers
+  # so they don't each rebuild token lists or parse the text again
+
+  def __init__(self, text, doc, sent = None, intents = None, similar = None):
+    # text: the message as sent by the user
+    # doc: the text as parsed by the spacy pipeline
+    # sent: VADER sentiment analyzer (optional)
+    # intents: keyphrases found in text, see IntentMatcher.match
+    # similar: (intent, score) the text is most similar to, if any,
+    #   see IntentClassifier.classify
+
+    self.text = text # raw text
+    self.lower = text.lower() # lowercased text
+    self.doc = doc # parsed doc
+    self.tokens = [d.text for d in doc] # token texts
+    self.lowertokens = [t.lower() for t in self.tokens] # lowercased
+    self.tokenset = set(self.lowertokens) # for membership checks
+    self.sent = sent
+    self.sentiment = None
+    self.intents = {} if intents is None else intents
+    self.similar = similar
+
+  def __str__(self):
+    return self.text
+
+  def getSentiment(self):
+    # VADER polarity scores of the text, computed on first use
+
+    if self.sentiment is None and self.sent is not None:
+      self.sentiment = self.sent.polarity_scores(self.text)
+    return self.sentiment
+
+  def argument(self, intent):
+    # the word following the first keyphrase of intent in the text,
+    # e.g. the name in 'my name is ...', or None if there is none
+    # only keyphrases matched as whole words count, so the 'i am' in
+    # 'hi amy' does not give 'y'
+
+    for start, end, phrase in self.intents.get(intent, []):
+      if ((start == 0 or not self.text[start - 1].isalnum()) and
+        (end == len(self.text) or not self.text[end].isalnum())):
+        words = self.text[end:].split()
+        return words[0].strip('.,!?') if words else None
+    return None
 
 # ******************** CHATBOT MODEL CLASS ************************
 
@@ -46,11 +102,33 @@ class MyModel(Model):
   # fields in parameter dict used in this model: 
   # qdbname: name/path to sqlite database file with quotes per character
   # sdbname: name/path to sqlite database file with summary per episode
-  # mtitlename: name/path to txt file holding ALL available episode titles
-  # msumname: name/path to txt file holding ALL available episode synopses
-  # mquotename: name/path to txt file holding ALL available quotes
+  # snapshotdir: if given, directory to keep markov chain snapshots in
+  #   the chains are then memory-mapped from there on startup, and only
+  #   rebuilt when the rows of their database have changed
   # usenlpformarkov: if True, use nlp pos tags for markov text generation
   # cartmanify: if True, will use markov chain to 'personify' answers
+  # poolsize: if > 0, keep this many pre-generated markov texts per model
+  #   (titles, synopses, quotes and each character) ready to respond with
+  # poollowwater: refill a pool when it holds fewer texts than this
+  # poolworkers: number of background threads refilling the pools
+  # nlpneeded: spacy pipeline components (e.g. 'parser', 'ner') that
+  #   must run on each message. the tagger always runs, others are off
+  # charcachebytes: budget in bytes for the character markov chains kept
+  #   in memory (0 for no limit), least recently used ones are evicted
+  # charcachesize: maximum number of character chains kept (0: no limit)
+  # charspill: if True (and snapshotdir is given), evicted character
+  #   chains are written to snapshots and reloaded from there when needed
+  # prebuildchars: number of characters (those with the most quotes) to
+  #   build the markov chains of at startup, in parallel processes
+  #   chains that are not ready yet are still built when first needed
+  # prebuildworkers: number of processes for that (default: all cores)
+  # charaliases: dict of nickname -> character name as in the quotes db
+  #   so the character can also be asked for by its nickname
+  # intentsim: if True, also detect queries by word vector similarity
+  #   of the message to their keyphrases (needs a pipeline with word vectors)
+  #   off by default
+  # intentthresh: minimum similarity for a query to be detected that way
+  # intentmargin: minimum similarity lead over the next best query
   # debug: if True, will output debug messages
 
   # ************************ CONSTRUCTOR ********************************
@@ -67,9 +145,7 @@ class MyModel(Model):
     # get database names as given in the parameters or default them
     qdbname = 'SouthParkEpisodesDB.sqlite' if 'qdbname' not in self.pars else self.pars['qdbname']
     sdbname = 'SouthParkEpisodesSummariesDB.sqlite' if 'sdbname' not in self.pars else self.pars['sdbname']
-    msumname = 'SouthParkEpisodeSummariesALL.txt' if 'msumname' not in self.pars else self.pars['msumname']
-    mtitlename = 'SouthParkEpisodeTitlesALL.txt' if 'mtitlename' not in self.pars else self.pars['mtitlename']
-    mquotename = 'SouthParkEpisodeQuotesALL.txt' if 'mquotename' not in self.pars else self.pars['mquotename']
+    self.snapshotdir = None if 'snapshotdir' not in self.pars else self.pars['snapshotdir']
     
     # load and setup the quotes and episode summary databases
     self.qdb = DBHelper(dbname=qdbname) # quotes database
@@ -78,20 +154,65 @@ class MyModel(Model):
     self.sdb.setup()
     
     # initialize the markov chain text generators
-    self.mtitle = TextMarkovChain(filename = mtitlename, depth = 2)
-    self.msum = TextMarkovChain(filename = msumname, depth = 2)
-    self.mquote = TextMarkovChain(filename = mquotename, depth = 2)
-    self.mchar = {} # holds markovchainmodels per requested character
+    # straight from the database rows, one title, synopsis or quote each
+    self.mtitle = TextMarkovChain(rows = sorted(self.sdb.get_keys()),
+      depth = 2, snapshot = self.SnapshotName(sdbname + '.titles'),
+      checksum = self.sdb.fingerprint())
+    self.msum = TextMarkovChain(rows = self.sdb.iter_items(), depth = 2,
+      snapshot = self.SnapshotName(sdbname + '.synopses'),
+      checksum = self.sdb.fingerprint())
+    self.mquote = TextMarkovChain(rows = self.qdb.iter_items(), depth = 2,
+      snapshot = self.SnapshotName(qdbname + '.quotes'),
+      checksum = self.qdb.fingerprint())
     
     # get all characters and episodes we have data of
-    self.chars = self.qdb.get_keys() # which characters do we have quotes from
+    self.chars = sorted(self.qdb.get_keys()) # which characters do we have quotes from
+    # nicknames of characters, as in {'garrison': 'Mr. Garrison'}
+    self.charaliases = {} if 'charaliases' not in self.pars else self.pars['charaliases']
+    self.BuildCharIndex() # lookup of characters by name
     self.episodes = self.sdb.get_keys() # which episode titles do we have?
     
     # initialize spacy's natural language processing pipeline for english
-    self.nlp = spacy.load('en')
+    nlpname = 'en'
+    self.nlp = spacy.load(nlpname)
+    # pipeline components the queries need on top of the tagger
+    # the others are disabled when parsing messages
+    self.nlpneeded = set() if 'nlpneeded' not in self.pars else set(self.pars['nlpneeded'])
+    self.nlpdisable = [p for p in ['parser', 'ner']
+      if p in self.nlp.pipe_names and p not in self.nlpneeded]
     # do we want to use nlp pos tags for markov chain text generation?
     self.usenlpformarkov = False if 'usenlpformarkov' not in self.pars else self.pars['usenlpformarkov']
     self.cartmanify = False if 'cartmanify' not in self.pars else self.pars['cartmanify']
+
+    # holds markovchainmodels per requested character, within a budget
+    spilldir = None
+    if self.pars.get('charspill', False) and self.snapshotdir is not None:
+      spilldir = os.path.join(self.snapshotdir, 'chars')
+    self.mchar = ModelCache(
+      maxbytes = self.pars.get('charcachebytes', 256 << 20),
+      maxentries = self.pars.get('charcachesize', 0),
+      spilldir = spilldir, nlp = self.nlp, onevict = self.CharModelEvicted)
+    # build the chains of the characters with the most quotes up front,
+    # in worker processes, while we already start answering
+    prebuildchars = 0 if 'prebuildchars' not in self.pars else self.pars['prebuildchars']
+    self.prebuilder = None
+    if prebuildchars > 0:
+      self.prebuilder = ChainPrebuilder(qdbname,
+        [char for char, count in self.qdb.get_key_counts()[:prebuildchars]],
+        nlp = self.nlp, nlpname = nlpname, depth = 2,
+        workers = self.pars.get('prebuildworkers', None),
+        ondone = self.CharModelPrebuilt)
+
+    # pools of pre-generated markov texts, refilled in the background
+    poolsize = 0 if 'poolsize' not in self.pars else self.pars['poolsize']
+    self.pool = None
+    if poolsize > 0:
+      self.pool = ResponsePool(size = poolsize,
+        lowwater = self.pars.get('poollowwater', poolsize // 5),
+        workers = self.pars.get('poolworkers', 1))
+      self.pool.register('title', lambda n: self.mtitle.generateTexts(n, 15))
+      self.pool.register('sum', lambda n: self.msum.generateTexts(n, 150))
+      self.pool.register('quote', lambda n: self.mquote.generateTexts(n, 50))
     
     # if set to true, will give debug messages
     self.debug = self.pars['debug'] if 'debug' in self.pars else False
@@ -130,6 +251,15 @@ class MyModel(Model):
       '/info':['/help','/info'],
       'cartmanify':['cartmanify'],
     }
+    # all keyphrases compiled into one automaton, matched once per message
+    self.intentmatcher = IntentMatcher(self.queryphrases)
+    # and embedded into one matrix, to detect queries by similarity
+    # (only if the pipeline has word vectors, en_core_web_sm has none)
+    self.intentthresh = 0.75 if 'intentthresh' not in self.pars else self.pars['intentthresh']
+    self.intentclassifier = None
+    if self.pars.get('intentsim', False) and self.nlp.vocab.vectors_length > 0:
+      self.intentclassifier = IntentClassifier(self.nlp.vocab,
+        self.queryphrases, self.pars.get('intentmargin', 0.05))
     
     print('\tModel initialization done!')
 
@@ -137,13 +267,18 @@ class MyModel(Model):
 
   def respond(self, text, chat):
     # create spacy natural language pipeline analysis of text
+    # (without the pipeline components none of the queries need)
+    # and wrap it in a message context that all queries share
     # then go through all queries that we specified can be made
     # see if it was said query, and if so, output back the response
 
-    doc = self.nlp(text)
+    msg = MessageContext(text, self.nlp(text, disable=self.nlpdisable),
+      self.sent, self.intentmatcher.match(text))
+    if self.intentclassifier is not None:
+      msg.similar = self.intentclassifier.classify(msg.lowertokens)
 
     for query in self.queries:
-      (isQuery,response) = query(doc, chat)
+      (isQuery,response) = query(msg, chat)
       if isQuery:
         break
 
@@ -151,76 +286,87 @@ class MyModel(Model):
 
   # ************************ QUERY CHECKER ****************************
 
-  def CheckQuery(self, doc, command, keyphrases=[], simthresh = 0.75):
-    # checks if the nlprocessed text of the user (doc) has any commands
+  def CheckQuery(self, msg, command, keyphrases=[], simthresh = None):
+    # checks if the nlprocessed text of the user (msg) has any commands
     # or keyphrases in them, in which case return True, as in:
     # the input text has in it the query which we can do something with.
     #
-    # TODO: implement similarity to keyphrases such that they are 
-    # robust. If certainty of this similarity to the keyphrases is
-    # greater than the similarity-threshold, then return True as well
+    # If the text is most similar to the keyphrases of this command, and
+    # the certainty of this similarity is greater than the 
+    # similarity-threshold simthresh (default: intentthresh), then 
+    # return True as well
+
+    if command in msg.tokenset:
+      return True
 
-    if command in [str(d).lower() for d in doc]:
+    # keyphrases of the query were already matched along with all others
+    spans = msg.intents.get(command)
+    if spans:
+      self.DebugLog('CheckQuery TRUE for: {0}, {1}, {2}'.format(
+        command, spans[0][2], msg.text))
       return True
 
     if len(keyphrases) >= 1:
       
+      compiled = self.queryphrases.get(command, [])
       for key in keyphrases:
-        if key in str(doc):
+        if key not in compiled and key in msg.text:
           self.DebugLog('CheckQuery TRUE for: {0}, {1}, {2}'.format(
-            command, key, str(doc)))
+            command, key, msg.text))
           return True
 
-      certainty = 0
-      # calculate certainty that input sentence is similar enough
-      # to keyphrases
-      # NOT YET IMPLEMENTED.
-      if certainty >= simthresh:
-        return True
+      # certainty that input sentence is similar enough to keyphrases
+      # was calculated for all queries at once, see IntentClassifier
+      if simthresh is None:
+        simthresh = self.intentthresh
+      if msg.similar is not None and msg.similar[0] == command:
+        certainty = msg.similar[1]
+        if certainty >= simthresh:
+          self.DebugLog('CheckQuery SIMILAR for: {0}, {1:.2f}, {2}'.format(
+            command, certainty, msg.text))
+          return True
 
     return False
 
   # ************************ QUERY HANDLERS ****************************
 
-  def InfoQuery(self, doc, chat):
+  def InfoQuery(self, msg, chat):
     # Checks if user has entered a query to get information on the bot
     # if so, return information on the bot, what commands and phrases
     # can be used, etc.
 
-    if self.CheckQuery(doc, '/info', self.queryphrases['/info']):
+    if self.CheckQuery(msg, '/info', self.queryphrases['/info']):
       return (True, self.infostring())
-    return (False, str(doc))
+    return (False, msg.text)
 
-  def SetCharacterQuery(self, doc, chat):
+  def SetCharacterQuery(self, msg, chat):
     # Checks if the user has entered a query to set/change the character
     # if so, set the current character of this chat
     # and return a response of the character
 
-    if self.CheckQuery(doc, 'setchar', self.queryphrases['setchar']):
-      for d in doc:
-        for c in range(0,len(self.chars)):
-          if str(d).lower() == self.chars[c].lower():
-            self.SetCurrentChar(chat,c)
-            return (True, self.GetCharacterResponse(doc,chat))
+    if self.CheckQuery(msg, 'setchar', self.queryphrases['setchar']):
+      c = self.FindChar(msg.lower)
+      if c is not None:
+        self.SetCurrentChar(chat,c)
+        return (True, self.GetCharacterResponse(msg,chat))
 
-    return (False, str(doc))
+    return (False, msg.text)
 
-  def GenerateQuoteAsCharQuery(self, doc, chat):
+  def GenerateQuoteAsCharQuery(self, msg, chat):
     # Checks if the user has entered a query to request a character quote
     # if so, set the current character of this chat
     # and return a response of the character
     # this will actually generate a markov-text response rather than a
     # quote of the character from the scripts
 
-    if self.CheckQuery(doc, 'sayaschar', self.queryphrases['sayaschar']):
-      for d in doc:
-        for c in range(0,len(self.chars)):
-          if str(d).lower() == self.chars[c].lower():
-            self.SetCurrentChar(chat,c)
-            return (True, self.SaySomethingLike(doc, chat))
-    return (False, str(doc))
+    if self.CheckQuery(msg, 'sayaschar', self.queryphrases['sayaschar']):
+      c = self.FindChar(msg.lower)
+      if c is not None:
+        self.SetCurrentChar(chat,c)
+        return (True, self.SaySomethingLike(msg, chat))
+    return (False, msg.text)
 
-  def GreetingsQuery(self, doc, chat):
+  def GreetingsQuery(self, msg, chat):
     # Checks if the user has entered a query to request a greeting
     # if so, greet the chat partner.
     # if, in addition, the chat partner has entered a query to set
@@ -232,21 +378,29 @@ class MyModel(Model):
     # similarity to 'personalize' the response like the character
     # that this chat session has been set to
 
-    if self.CheckQuery(doc, 'setname', self.queryphrases['setname']):
-      value = str(doc[1])
+    # the name is taken from after a setname keyphrase or command only
+    # a message that is merely similar to them has no name to take
+    if self.CheckQuery(msg, 'setname', self.queryphrases['setname']):
+      value = msg.argument('setname')
+      if value is None and 'setname' in msg.tokenset:
+        i = msg.lowertokens.index('setname') + 1
+        value = msg.tokens[i] if i < len(msg.tokens) else ''
+    else:
+      value = None
+    if value is not None:
       self.SetPartnerInfo(chat, 'name', value)
       text = 'Hello {0}!'.format(self.GetPartnerInfo(chat,'name'))
       if self.cartmanify:
         text = self.Cartmanify(text, chat)
       return (True, text)
-    if self.CheckQuery(doc, 'sayhi', self.queryphrases['sayhi']):
+    if self.CheckQuery(msg, 'sayhi', self.queryphrases['sayhi']):
       text = 'Hello {0}!'.format(self.GetPartnerInfo(chat,'name'))
       if self.cartmanify:
         text = self.Cartmanify(text, chat)
       return (True,text)
-    return (False, str(doc))
+    return (False, msg.text)
 
-  def GoodbyeQuery(self, doc, chat):
+  def GoodbyeQuery(self, msg, chat):
     # Checks if the user has entered a query to request a farewell
     # if so, say goodbye to the chat partner.
     # will append the name info field to the greeting as well, if
@@ -256,78 +410,145 @@ class MyModel(Model):
     # similarity to 'personalize' the response like the character
     # that this chat session has been set to
 
-    if self.CheckQuery(doc, 'saybye', self.queryphrases['saybye']):
+    if self.CheckQuery(msg, 'saybye', self.queryphrases['saybye']):
       text = 'Goodbye {0}!'.format(self.GetPartnerInfo(chat,'name'))
       if self.cartmanify:
         text = self.Cartmanify(text, chat)
       return (True, text)
-    return (False, str(doc))
+    return (False, msg.text)
 
-  def CartmanifyQuery(self, doc, chat):
+  def CartmanifyQuery(self, msg, chat):
     # Checks if the user has entered a query to request a cartmanification
     # if so, cartmanify the rest of the chat partner's input query.
     # this is mostly for testing the cartmanify function
 
-    if self.CheckQuery(doc, 'cartmanify', self.queryphrases['cartmanify']):
-      print(str(doc))
-      text = str(doc).replace('cartmanify','')
+    if self.CheckQuery(msg, 'cartmanify', self.queryphrases['cartmanify']):
+      print(msg.text)
+      text = msg.text.replace('cartmanify','')
       print(text)
       for phrase in self.queryphrases['cartmanify']:
         text = text.replace(phrase,'')
         print(text)
       if self.cartmanify:
-        text = self.Cartmanify(text, chat)
+        # reuse the tokens we already parsed, rather than parsing again
+        tokens = [d for d in msg.doc
+          if d.lower_ not in self.queryphrases['cartmanify']]
+        text = self.Cartmanify(text, chat, tokens)
       return (True, text)
-    return (False, str(doc))
+    return (False, msg.text)
 
-  def SynopsisQuery(self, doc, chat):
+  def SynopsisQuery(self, msg, chat):
     # Checks if the user has entered a query to request a synopsis
     # if so, get a random synopsis from the episodes
     # and return it
 
-    if self.CheckQuery(doc, 'givesyn', self.queryphrases['givesyn']):
+    if self.CheckQuery(msg, 'givesyn', self.queryphrases['givesyn']):
       titles = self.episodes
       r = random.randrange(0,len(titles))
       title = titles[r]
-      item = self.sdb.get_items(title)[0]
+      item = self.sdb.random_item(title)
       self.DebugLog(title,item,chat=chat)
       return (True, 'Summary for '+title+'\n\n'+item)
-    return (False, str(doc))
+    return (False, msg.text)
 
-  def GenerateSynopsisQuery(self, doc, chat):
+  def GenerateSynopsisQuery(self, msg, chat):
     # Checks if the user has entered a query to request a
     # markov-generated synopsis
     # if so, get a markov-text generated synopsis
     # and return it
 
-    if self.CheckQuery(doc, 'createsyn', self.queryphrases['createsyn']):
+    if self.CheckQuery(msg, 'createsyn', self.queryphrases['createsyn']):
       return (True, 'Summary for ' + 
-        self.mtitle.generateText(15) + 
+        self.PoolText('title', lambda: self.mtitle.generateText(15)) + 
         '\n\n' + 
-        self.msum.generateText(150))
-    return (False, str(doc))
+        self.PoolText('sum', lambda: self.msum.generateText(150)))
+    return (False, msg.text)
 
-  def GenerateQuoteQuery(self, doc, chat):
+  def GenerateQuoteQuery(self, msg, chat):
     # Checks if the user has entered a query to request a
     # markov-generated quote (non-character specific)
     # if so, get a markov-text generated synopsis
     # and return it
 
-    if self.CheckQuery(doc, 'createquot', self.queryphrases['createquot']):
-      return (True, self.mquote.generateText(50))
-    return (False, str(doc))
+    if self.CheckQuery(msg, 'createquot', self.queryphrases['createquot']):
+      return (True, self.PoolText('quote',
+        lambda: self.mquote.generateText(50)))
+    return (False, msg.text)
 
-  def IdleQuery(self, doc, chat):
+  def IdleQuery(self, msg, chat):
     # if all other queries fail, just return an idle response.
     # if a character has been set, this will be a random quote
     # if not, it will just echo back the user input
 
     if chat in self.currentChar:
-      return (True, self.GetCharacterResponse(doc,chat)) 
-    return (True, str(doc)) # just echo when all else fails
+      return (True, self.GetCharacterResponse(msg,chat)) 
+    return (True, msg.text) # just echo when all else fails
 
   # ******************* GETTERS AND SETTERS ***************************
 
+  def CharKey(self, name):
+    # the lowercased words of a (character) name, as a lookup key
+    # for example: self.CharKey('Mr. Garrison') returns ('mr', 'garrison')
+
+    return tuple(re.findall(r"[\w']+", name.lower()))
+
+  def BuildCharIndex(self):
+    # (re)builds the lookup of characters (their index in self.chars)
+    # by the words of their name, and by their aliases:
+    # - the nicknames given in self.charaliases
+    # - the last word of a multi-word name, if no other name ends in it
+    #   and no one is called just that (so 'Mr. Garrison' can be asked
+    #   for as 'garrison', unless there is a 'Mrs. Garrison' too)
+
+    index = {}
+    for c in range(0, len(self.chars)):
+      index.setdefault(self.CharKey(self.chars[c]), c)
+    lastwords = {} # last word of multi-word names -> how many end in it
+    for name in self.chars:
+      key = self.CharKey(name)
+      if len(key) > 1:
+        lastwords[key[-1:]] = lastwords.get(key[-1:], 0) + 1
+    for c in range(0, len(self.chars)):
+      key = self.CharKey(self.chars[c])
+      if len(key) > 1 and lastwords[key[-1:]] == 1:
+        index.setdefault(key[-1:], c)
+    for alias, name in self.charaliases.items():
+      c = index.get(self.CharKey(name))
+      if c is not None:
+        index[self.CharKey(alias)] = c
+    index.pop((), None)
+    self.charindex = index
+    # lengths (in words) of the names, longest first
+    self.charnamelengths = sorted(set(len(k) for k in index), reverse=True)
+    self.charversion = self.qdb.change_count()
+
+  def RefreshChars(self):
+    # picks up characters that were added to the quotes database
+    # since the index was built (told by its change counter, which is
+    # read without waiting for writes, see DBHelper.change_count)
+    # new characters are appended, so the indices in self.currentChar
+    # stay valid
+
+    if self.qdb.change_count() == self.charversion:
+      return
+    known = set(self.chars)
+    self.chars.extend(c for c in self.qdb.get_keys() if c not in known)
+    self.BuildCharIndex()
+
+  def FindChar(self, text):
+    # returns the index in self.chars of the first character
+    # mentioned by name (or alias) in text, or None if there is none
+    # longer names win, so 'mr garrison' is not taken for a 'mr'
+
+    self.RefreshChars()
+    words = self.CharKey(text)
+    for i in range(0, len(words)):
+      for n in self.charnamelengths:
+        c = self.charindex.get(tuple(words[i:i + n]))
+        if c is not None:
+          return c
+    return None
+
   def SetCurrentChar(self, chat, char_index):
     # sets the current chat's active character to the one given
 
@@ -352,7 +573,7 @@ class MyModel(Model):
       self.partnerInfo[chat] = {}
     self.partnerInfo[chat][key] = value
 
-  def Cartmanify(self, text, chat):
+  def Cartmanify(self, text, chat, tokens = None):
     # NOTE: THIS DOES NOT WORK VERY WELL
     # 
     # This function will get some generated text to be output
@@ -360,6 +581,7 @@ class MyModel(Model):
     # by substituting words in the given tags with
     # words that the character uses a lot as given in the markov model
     # on the basis of which nlp-tags they are, and similarity
+    # if the text has already been parsed, pass its tokens as tokens
     #
     # TODO: make this work better
     # ideas: 
@@ -372,16 +594,12 @@ class MyModel(Model):
       currentChar = self.currentChar[chat]
     if currentChar != -1:
       char = self.chars[currentChar]
-      if char in self.mchar:
-        text = self.mchar[char].Cartmanify(text, 50, True)
-      else:
-        self.mchar[char] = TextMarkovChain(depth=2,
-          textlist=self.qdb.get_items(char), nlp=self.nlp)
-        text = self.mchar[char].Cartmanify(text, 50, True)
+      text = self.GetCharModel(char).Cartmanify(
+        text if tokens is None else tokens, 50, True)
       return '{0}: {1}'.format(char,text)
     return text
 
-  def GetCharacterResponse(self, doc, chat):
+  def GetCharacterResponse(self, msg, chat):
     # this will return some random character response
     # 
     # TODO: make this more 'chatty'
@@ -393,16 +611,14 @@ class MyModel(Model):
     #     a quote to respond with on the basis of similarity to
     #     a 'normal' chat answer 
 
-    self.DebugLog('sentiment: {0}'.format(
-      self.sent.polarity_scores(str(doc))),
+    self.DebugLog('sentiment: {0}'.format(msg.getSentiment()),
       chat=chat)
     char_index = self.currentChar[chat]
     char = self.chars[char_index]
-    dbitems = self.qdb.get_items(char)
-    item = dbitems[random.randrange(0,len(dbitems))]
+    item = self.qdb.random_item(char)
     return '{0}: {1}'.format(char,item)
 
-  def SaySomethingLike(self, doc, chat):
+  def SaySomethingLike(self, msg, chat):
     # this will return a response text that will be based on the
     # markov text chain model as trained on the character's
     # quotes from the scripts as a corpus
@@ -421,18 +637,89 @@ class MyModel(Model):
       currentChar = self.currentChar[chat]
     if currentChar != -1:
       char = self.chars[currentChar]
-      if char in self.mchar:
-        text = self.mchar[char].generateText(50, True,
-          self.usenlpformarkov)
-      else:
-        self.mchar[char] = TextMarkovChain(depth=2,
-          textlist=self.qdb.get_items(char), nlp=self.nlp)
-        text = self.mchar[char].generateText(50, True,
-          self.usenlpformarkov)
+      model = self.GetCharModel(char)
+      text = self.PoolText('char:' + char,
+        lambda: model.generateText(50, True, self.usenlpformarkov))
     return '{0}: {1}'.format(char,text)
 
+  def GetCharModel(self, char):
+    # returns the markov chain model trained on the quotes of char
+    # building it the first time the character is asked for
+    # (or after it was evicted from the cache of character models)
+    # chats asking for the same character at once share a single build
+    # if we keep response pools, a pool for the character is added too
+    # that is done under the cache's lock, and only if the chain is
+    # still cached: evictions (which drop the pool) happen under the
+    # same lock, so a pool is never added for an evicted chain. the pool
+    # looks up the cached chain on each refill, see CharPoolTexts
+
+    model = self.mchar.get(char, lambda: TextMarkovChain(depth=2,
+      rows=self.qdb.iter_items(char), nlp=self.nlp))
+    if self.pool is not None:
+      with self.mchar.lock:
+        if self.mchar.peek(char) is model and 'char:' + char not in self.pool:
+          self.pool.register('char:' + char,
+            lambda n: self.CharPoolTexts(char, n))
+    return model
+
+  def CharPoolTexts(self, char, n):
+    # generates n texts for the response pool of char, with the chain
+    # that is cached for char now (none if it was evicted meanwhile)
+
+    model = self.mchar.peek(char)
+    if model is None:
+      return []
+    return model.generateTexts(n, 50, True, self.usenlpformarkov)
+
+  def CharModelPrebuilt(self, char, model):
+    # a chain was prebuilt: cache it, unless it was built meanwhile
+
+    self.mchar.put(char, model, replace = False)
+
+  def CharModelEvicted(self, char):
+    # the model of char was evicted from the cache: drop its pool too,
+    # as the pool's generator would keep the model in memory
+
+    if self.pool is not None:
+      self.pool.unregister('char:' + char)
+
+  def AddCharacterQuote(self, char, quote):
+    # adds a new quote of char to the quotes database
+    # and lets the live markov chains learn it right away,
+    # i.e. the quotes chain and the character's chain, if built
+
+    self.qdb.add_item(quote, char)
+    if char not in self.chars:
+      self.chars.append(char)
+      self.BuildCharIndex()
+    model = self.mchar.peek(char)
+    if model is not None:
+      model.update(quote)
+    self.mchar.changed(char)
+    self.mquote.update(quote)
+
+  def PoolText(self, key, generate):
+    # pops a pre-generated text from the response pool of key
+    # or, without pools or when the pool ran dry, calls generate()
+
+    if self.pool is None:
+      return generate()
+    return self.pool.get(key, generate)
+
   # ************************ MISC FUNCTIONS *****************************
 
+  def SnapshotName(self, name):
+    # returns the path of the snapshot file for the markov chain
+    # with the given name (e.g. its database and corpus),
+    # or None if we do not keep snapshots
+
+    if self.snapshotdir is None:
+      return None
+    if not os.path.isdir(self.snapshotdir):
+      os.makedirs(self.snapshotdir)
+    return os.path.join(self.snapshotdir,
+      '{0}.tmc'.format(os.path.basename(name)))
+
   def DebugLog(self, *debugtext, chat=''):
     # displays debug messages if we have set debug mode to True
     # if chat parameter is specified, it will specify which chat
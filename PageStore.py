@@ -0,0 +1,242 @@
+# Compressed, content-addressed single-file archive of the pages crawled
+# by EpSpider, read by the script and synopsis processors
+# each page body is kept once, compressed (zstd if the zstandard module
+# is installed, else gzip), under its sha256 hash, so pages with the same
+# content (redirects, unchanged re-crawls) take up space only once. an
+# index maps the key of each page (such as
+# 'script/Cartman_Gets_an_Anal_Probe') to its hash, and to the http
+# validators (ETag, Last-Modified) used for conditional re-crawls
+#
+# file layout:
+#   header: ARCHIVEMAGIC
+#   members: the compressed page bodies, back to back
+#   index: zlib-compressed json of the pages and where their bodies are
+#   trailer: TRAILERMAGIC, offset and size of the index
+# new pages are appended after the last index, followed by a new index
+# and trailer, so a write that gets interrupted never damages what was
+# in the archive before: on opening, the last complete trailer wins and
+# anything after it is cut off on the next write. compact() drops the
+# old indexes and unused bodies
+
+# ************************ IMPORTS ********************************
+
+import os
+import gzip
+import json
+import time
+import zlib
+import struct
+import hashlib
+import threading
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+ARCHIVEMAGIC = b'SPPAGES1'
+TRAILERMAGIC = b'SPPAIDX1'
+TRAILER = struct.Struct('=8sQQ') # magic, index offset, index size
+SAVEEVERY = 20 # new pages after which the index is written out
+SCANCHUNK = 1 << 20 # bytes read at once when looking for a trailer
+
+def compress(body):
+  # returns (codec, compressed body)
+
+  if zstandard is not None:
+    return 'zstd', zstandard.ZstdCompressor(level = 10).compress(body)
+  return 'gzip', gzip.compress(body)
+
+def decompress(codec, data):
+  if codec == 'zstd':
+    if zstandard is None:
+      raise ValueError('page is zstd-compressed, install zstandard')
+    return zstandard.ZstdDecompressor().decompress(data)
+  return gzip.decompress(data)
+
+class PageStore():
+
+  # ************************ CONSTRUCTOR *****************************
+
+  def __init__(self, filename = 'pages.archive', readonly = False):
+    # opens the archive in filename, creating it if needed
+    # (unless readonly: then a missing archive is just empty)
+
+    self.filename = filename
+    self.readonly = readonly
+    self.lock = threading.Lock()
+    self.pages = {} # key -> {'hash', 'url', 'etag', 'lastmodified', 'fetched'}
+    self.objects = {} # hash -> [offset, size, codec] of its body
+    self.unsaved = 0 # index changes not written out yet
+    self.end = len(ARCHIVEMAGIC) # where the next member will be written
+    self.f = None
+    if readonly and not os.path.isfile(filename):
+      return
+    if not os.path.isfile(filename):
+      with open(filename, 'wb') as f:
+        f.write(ARCHIVEMAGIC)
+    self.f = open(filename, 'rb' if readonly else 'r+b')
+    if self.f.read(len(ARCHIVEMAGIC)) != ARCHIVEMAGIC:
+      raise ValueError('{0} is not a page archive'.format(filename))
+    self.loadIndex()
+
+  def loadIndex(self):
+    # finds the last complete trailer and loads the index it points to
+
+    self.f.seek(0, os.SEEK_END)
+    pos = self.f.tell()
+    while pos > len(ARCHIVEMAGIC):
+      start = max(len(ARCHIVEMAGIC), pos - SCANCHUNK)
+      self.f.seek(start)
+      chunk = self.f.read(pos - start + TRAILER.size)
+      i = chunk.rfind(TRAILERMAGIC)
+      while i >= 0:
+        if self.readIndex(start + i):
+          return
+        i = chunk.rfind(TRAILERMAGIC, 0, i)
+      pos = start
+
+  def readIndex(self, trailerpos):
+    # loads the index of the trailer at trailerpos, if it is complete
+
+    self.f.seek(trailerpos)
+    data = self.f.read(TRAILER.size)
+    if len(data) < TRAILER.size:
+      return False
+    magic, offset, size = TRAILER.unpack(data)
+    if offset + size != trailerpos:
+      return False
+    self.f.seek(offset)
+    try:
+      index = json.loads(zlib.decompress(self.f.read(size)).decode('utf-8'))
+    except (zlib.error, ValueError):
+      return False
+    self.pages = index['pages']
+    self.objects = index['objects']
+    self.end = trailerpos + TRAILER.size
+    return True
+
+  # ************************ READING *****************************
+
+  def __contains__(self, key):
+    return key in self.pages
+
+  def keys(self, prefix = ''):
+    # the keys of the pages in the archive, optionally only those
+    # starting with prefix (e.g. 'script/')
+
+    return sorted(k for k in self.pages if k.startswith(prefix))
+
+  def meta(self, key):
+    # the index entry of key (hash, url, validators), or None
+
+    entry = self.pages.get(key)
+    return None if entry is None else dict(entry)
+
+  def get(self, key):
+    # the body of the page of key, as bytes (random access)
+
+    offset, size, codec = self.objects[self.pages[key]['hash']]
+    with self.lock:
+      self.f.seek(offset)
+      data = self.f.read(size)
+    return decompress(codec, data)
+
+  def items(self, prefix = ''):
+    # yields (key, body) of all pages (starting with prefix), in the
+    # order they are stored in, so the archive is read front to back
+
+    keys = self.keys(prefix)
+    keys.sort(key = lambda k: self.objects[self.pages[k]['hash']][0])
+    for key in keys:
+      yield key, self.get(key)
+
+  # ************************ WRITING *****************************
+
+  def put(self, key, body, url = None, etag = None, lastmodified = None):
+    # stores the page body of key with its url and http validators
+    # the body is only written if no page with the same hash is stored
+    # yet. the index is written every SAVEEVERY pages and on close(),
+    # an interrupted crawl at most fetches the pages since then again
+    # returns the sha256 hash of the body
+
+    digest = hashlib.sha256(body).hexdigest()
+    codec, data = (None, None) if digest in self.objects else compress(body)
+    with self.lock:
+      if digest not in self.objects and data is not None:
+        self.f.seek(self.end)
+        self.f.write(data)
+        self.objects[digest] = [self.end, len(data), codec]
+        self.end += len(data)
+      self.pages[key] = {'hash': digest, 'url': url, 'etag': etag,
+        'lastmodified': lastmodified, 'fetched': time.time()}
+      self.unsaved += 1
+      if self.unsaved >= SAVEEVERY:
+        self.save()
+    return digest
+
+  def touch(self, key):
+    # notes that the page of key was found unchanged just now
+
+    with self.lock:
+      if key in self.pages:
+        self.pages[key]['fetched'] = time.time()
+        self.unsaved += 1
+
+  def importFiles(self, prefix, directory):
+    # adds the loose page files in directory (as written by earlier
+    # versions of EpSpider) under prefix + their file name
+    # returns the number of pages added
+
+    names = sorted(os.listdir(directory))
+    for name in names:
+      with open(os.path.join(directory, name), 'rb') as f:
+        self.put(prefix + name, f.read())
+    return len(names)
+
+  def save(self):
+    # appends the index and a trailer pointing to it
+    # must be called while holding self.lock
+
+    index = zlib.compress(json.dumps({'pages': self.pages,
+      'objects': self.objects}, sort_keys = True).encode('utf-8'))
+    self.f.seek(self.end)
+    self.f.write(index)
+    self.f.write(TRAILER.pack(TRAILERMAGIC, self.end, len(index)))
+    self.end += len(index) + TRAILER.size
+    self.f.truncate(self.end) # anything left by an interrupted write
+    self.f.flush()
+    os.fsync(self.f.fileno())
+    self.unsaved = 0
+
+  def compact(self):
+    # rewrites the archive without old indexes and unused bodies
+    # (next to it, and then renamed over it)
+
+    with self.lock:
+      used = sorted(set(p['hash'] for p in self.pages.values()),
+        key = lambda h: self.objects[h][0])
+      tmpname = '{0}.{1}.tmp'.format(self.filename, os.getpid())
+      objects = {}
+      with open(tmpname, 'wb') as f:
+        f.write(ARCHIVEMAGIC)
+        for digest in used:
+          offset, size, codec = self.objects[digest]
+          self.f.seek(offset)
+          objects[digest] = [f.tell(), size, codec]
+          f.write(self.f.read(size))
+      self.f.close()
+      os.replace(tmpname, self.filename)
+      self.f = open(self.filename, 'r+b')
+      self.objects = objects
+      self.end = self.f.seek(0, os.SEEK_END)
+      self.save()
+
+  def close(self):
+    if self.f is None:
+      return
+    with self.lock:
+      if self.unsaved > 0 and not self.readonly:
+        self.save()
+      self.f.close()
+      self.f = None
@@ -0,0 +1,126 @@
+# Pools of pre-generated responses for the south park chatbot
+# markov text generation is moved off the request path: requests pop
+# a ready-made text, and background workers refill the pools in batches
+
+# ************************ IMPORTS ********************************
+
+import threading
+from collections import deque
+
+class ResponsePool():
+
+  # ************************ CONSTRUCTOR *****************************
+
+  def __init__(self, size = 100, lowwater = 20, workers = 1):
+    # initializes an empty set of pools, one per registered key
+    # parameters:
+    #   - size: maximum number of texts kept per pool
+    #   - lowwater: refill a pool once it holds fewer texts than this
+    #   - workers: number of background threads refilling the pools
+
+    self.size = size
+    self.lowwater = lowwater
+    self.pools = {} # key -> deque of ready-made texts
+    self.generators = {} # key -> function(n) returning n new texts
+    self.pending = set() # keys waiting for, or being refilled
+    self.queue = deque() # keys waiting for a worker, in order
+    self.cond = threading.Condition()
+    self.running = True
+    self.threads = []
+    for i in range(0, workers):
+      t = threading.Thread(target = self.work, daemon = True,
+        name = 'ResponsePool-{0}'.format(i))
+      t.start()
+      self.threads.append(t)
+
+  # ************************ POOLS *****************************
+
+  def register(self, key, generator):
+    # adds a pool for key, filled by generator(n)
+    # generator should return a list of n texts, preferably generated
+    # in one batch (see TextMarkovChain.generateTexts)
+    # the pool is scheduled to be filled right away
+
+    with self.cond:
+      if key in self.pools:
+        return
+      self.pools[key] = deque()
+      self.generators[key] = generator
+      self.schedule(key)
+
+  def unregister(self, key):
+    # removes the pool of key, with its texts and generator
+    # a refill that is already running for it is thrown away
+
+    with self.cond:
+      self.pools.pop(key, None)
+      self.generators.pop(key, None)
+
+  def __contains__(self, key):
+    return key in self.pools
+
+  def get(self, key, fallback):
+    # pops a ready-made text from the pool of key
+    # if the pool is empty (or unknown), returns fallback() instead,
+    # which should generate a single text synchronously
+    # schedules a refill when the pool drops below the low-water mark
+
+    with self.cond:
+      pool = self.pools.get(key)
+      if pool is None:
+        return fallback()
+      text = pool.popleft() if pool else None
+      if len(pool) < self.lowwater:
+        self.schedule(key)
+    return fallback() if text is None else text
+
+  def schedule(self, key):
+    # marks the pool of key for refilling and wakes up a worker
+    # must be called while holding self.cond
+
+    if key not in self.pending:
+      self.pending.add(key)
+      self.queue.append(key)
+      self.cond.notify()
+
+  # ************************ WORKERS *****************************
+
+  def work(self):
+    # background worker: waits for pools to refill, tops them up
+    # to size in one batch, and repeats until stop() is called
+
+    while True:
+      with self.cond:
+        while self.running and not self.queue:
+          self.cond.wait()
+        if not self.running:
+          return
+        key = self.queue.popleft()
+        if key not in self.pools: # unregistered meanwhile
+          self.pending.discard(key)
+          continue
+        missing = self.size - len(self.pools[key])
+        generator = self.generators[key]
+      texts = []
+      if missing > 0:
+        try:
+          texts = generator(missing)
+        except Exception as e:
+          print('ResponsePool: refill of {0} failed: {1}'.format(key, e))
+      with self.cond:
+        self.pending.discard(key)
+        pool = self.pools.get(key)
+        if pool is None or self.generators.get(key) is not generator:
+          continue # unregistered (and maybe registered again) meanwhile
+        pool.extend(texts[:self.size - len(pool)])
+        if texts and len(pool) < self.lowwater:
+          self.schedule(key)
+
+  def stop(self):
+    # stops the background workers
+
+    with self.cond:
+      self.running = False
+      self.cond.notify_all()
+    for t in self.threads:
+      t.join()
@@ -6,70 +6,700 @@
 
 # ************************ IMPORTS ********************************
 
-import random, re, codecs
+import random, re, codecs, bisect
+import os, io, sys, struct, mmap, hashlib, threading
+from array import array
+import numpy as np
 import spacy
 
+KEYBITS = 32 # bits per token id when packing a prefix into one int key
+BATCHWORDS = 10000 # words per batch when streaming a corpus into a chain
+NLPBATCHES = 16 # batches the nlp pipeline may process at once
+NLPDISABLE = ['parser', 'ner'] # pipeline components we don't need tags from
+
+# boundary tokens put around each sentence of a row, see getRowBatches
+STARTTOKEN = '<s>'
+ENDTOKEN = '</s>'
+SENTENCEEND = re.compile(r'[.!?]["\')\]]*$') # word ending a sentence
+
+# on-disk snapshot format, see TextMarkovChain.saveSnapshot
+SNAPSHOTMAGIC = b'TMCS'
+SNAPSHOTVERSION = 6
+SNAPSHOTBOM = 0x01020304 # written natively, detects byte order mismatch
+SNAPSHOTHEADER = struct.Struct('=4sHIHH64sI')
+SNAPSHOTSECTION = struct.Struct('=8sc7xQQ')
+
+def fileChecksum(filename):
+  # sha256 hex digest of a file's contents, read in chunks
+
+  h = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+def arrayBytes(data):
+  # size in bytes of the items of an array or memoryview (0 for None)
+
+  return 0 if data is None else len(data) * data.itemsize
+
+def typeCode(data):
+  # typecode of an array, or format of a memoryview (from a snapshot)
+
+  return data.typecode if isinstance(data, array) else data.format
+
+def packStrings(strings):
+  # packs a list of strings into an offsets array and one utf-8 blob
+  # string i is blob[offsets[i]:offsets[i+1]]
+
+  offsets = array('q', [0])
+  blob = bytearray()
+  for string in strings:
+    blob += string.encode('utf-8')
+    offsets.append(len(blob))
+  return offsets, array('B', blob)
+
+def unpackStrings(offsets, blob):
+  # inverse of packStrings
+
+  blob = bytes(blob)
+  return [blob[offsets[i]:offsets[i+1]].decode('utf-8')
+    for i in range(0, len(offsets) - 1)]
+
+# ************************ VOCABULARY *****************************
+
+class Vocabulary():
+  # maps tokens (words, nlp tags) to consecutive integer ids and back
+  # so the markov tables can store small ints instead of python strings
+
+  def __init__(self, tokens = None):
+    # tokens: optional list of tokens to initialize the vocabulary with
+    #   their position in the list will be their id
+
+    self.tokens = [] # id -> token
+    self.ids = {} # token -> id
+    if tokens is not None:
+      for token in tokens:
+        self.encode(token)
+
+  def __len__(self):
+    return len(self.tokens)
+
+  def __getitem__(self, tokenid):
+    return self.tokens[tokenid]
+
+  def __contains__(self, token):
+    return token in self.ids
+
+  def encode(self, token):
+    # returns the id of token, adding it to the vocabulary if it is new
+
+    tokenid = self.ids.get(token)
+    if tokenid is None:
+      tokenid = len(self.tokens)
+      self.ids[token] = tokenid
+      self.tokens.append(token)
+    return tokenid
+
+  def get(self, token, default = -1):
+    # returns the id of token without adding it, or default if unknown
+
+    return self.ids.get(token, default)
+
+  def footprint(self):
+    # rough estimate of the memory the vocabulary takes, in bytes
+
+    return (sys.getsizeof(self.tokens) + sys.getsizeof(self.ids) +
+      sum(sys.getsizeof(t) for t in self.tokens) +
+      sys.getsizeof(0) * len(self.tokens))
+
+# ************************ TRANSITION TABLE *****************************
+
+class TransitionTable():
+  # count-weighted n-gram transition table over integer token ids
+  #
+  # a prefix of depth-1 ids is packed into a single int key
+  # (KEYBITS bits per id), so a rolling prefix can be advanced with
+  # key = ((key << KEYBITS) | nextid) & keymask
+  #
+  # while building, successor counts are gathered per prefix in a dict
+  # compile() then packs them into flat arrays, one row per prefix:
+  #   rows: prefix key -> row index
+  #   rowprefix: the depth-1 ids of each row, back to back
+  #   rowstart: successors of row r are at [rowstart[r], rowstart[r+1])
+  #   successors: successor ids
+  #   cumcounts: running count of the successors within their row
+  # sampling a successor by count is then a bisect on cumcounts
+  #
+  # with sampling set to 'alias', compile() also builds Walker/Vose
+  # alias tables next to the successors, which makes each draw O(1):
+  #   aliasprob: chance to keep the successor in this slot
+  #   aliassucc: successor id to take instead
+
+  def __init__(self, depth, sampling = 'alias'):
+    # depth: length of the n-grams, i.e. depth-1 ids predict the next id
+    # sampling: 'alias' for O(1) alias table draws, or 'cumulative'
+    #   for O(log n) bisect draws on the cumulative counts only
+
+    self.depth = depth
+    self.sampling = sampling
+    self.keymask = (1 << (KEYBITS * (depth - 1))) - 1
+    self.counts = {} # prefix key -> {successor id: count}, until compiled
+    self.rows = {}
+    self.rowprefix = array('I')
+    self.rowstart = array('q', [0])
+    self.successors = array('I')
+    self.cumcounts = array('I')
+    self.aliasprob = None
+    self.aliassucc = None
+    self.batcharrays = None # numpy views for walkMany, built on demand
+    self.startcum = None # running row totals for sampleStart, on demand
+
+  def __len__(self):
+    return len(self.rowstart) - 1
+
+  def __contains__(self, key):
+    return key in self.rows
+
+  def makeKey(self, ids):
+    # packs a sequence of depth-1 token ids into one int key
+
+    key = 0
+    for i in ids:
+      key = (key << KEYBITS) | i
+    return key
+
+  def splitKey(self, key):
+    # unpacks an int key into its depth-1 token ids
+
+    mask = (1 << KEYBITS) - 1
+    return [(key >> (KEYBITS * (self.depth - 2 - d))) & mask
+      for d in range(0, self.depth - 1)]
+
+  def add(self, key, val, count = 1):
+    # counts count occurrences of successor id val after prefix key
+
+    succ = self.counts.get(key)
+    if succ is None:
+      succ = self.counts[key] = {}
+    succ[val] = succ.get(val, 0) + count
+
+  def addSequence(self, ids):
+    # counts every n-gram in the sequence of token ids ids
+    # the same n-grams as getTuple would give, i.e. 
+    # the last word of the sequence is not used as a predicted value
+
+    n = self.depth - 1
+    if len(ids) < self.depth:
+      return
+    counts = self.counts
+    keymask = self.keymask
+    key = self.makeKey(ids[0:n])
+    for i in range(n, len(ids) - 1):
+      val = ids[i]
+      succ = counts.get(key)
+      if succ is None:
+        succ = counts[key] = {}
+      succ[val] = succ.get(val, 0) + 1
+      key = ((key << KEYBITS) | val) & keymask
+
+  def compile(self):
+    # packs the gathered counts into the flat row arrays
+    # and frees the build-time count dicts
+
+    self.rows = {}
+    self.rowprefix = array('I')
+    self.rowstart = array('q', [0])
+    self.successors = array('I')
+    self.cumcounts = array('I')
+    for key in sorted(self.counts):
+      self.rows[key] = len(self.rows)
+      self.rowprefix.extend(self.splitKey(key))
+      c = 0
+      for val, count in self.counts[key].items():
+        c += count
+        self.successors.append(val)
+        self.cumcounts.append(c)
+      self.rowstart.append(len(self.successors))
+    self.counts = {}
+    self.batcharrays = None
+    self.startcum = None
+    if self.sampling == 'alias':
+      self.buildAliasTables()
+
+  def buildAliasTables(self):
+    # builds the Walker/Vose alias tables of every row from cumcounts
+    # each slot j of a row with k successors and total count t holds
+    # a share count_j * k / t of the probability mass. slots below 1
+    # are topped up from a slot above 1, which becomes their alias
+    # integer arithmetic (scaled by t) keeps the tables exact
+
+    cumcounts = self.cumcounts
+    successors = self.successors
+    aliasprob = array('d', [1.0]) * len(successors)
+    aliassucc = array('I', successors)
+    for row in range(0, len(self)):
+      start = self.rowstart[row]
+      end = self.rowstart[row + 1]
+      counts = [cumcounts[i] - (cumcounts[i-1] if i > start else 0)
+        for i in range(start, end)]
+      for j, (prob, alias) in enumerate(zip(*self.aliasRow(counts))):
+        aliasprob[start + j] = prob
+        aliassucc[start + j] = successors[start + alias]
+    self.aliasprob = aliasprob
+    self.aliassucc = aliassucc
+
+  def aliasRow(self, counts):
+    # the alias table of one row with successor counts counts
+    # returns the keep-probabilities and the alias (index into counts)
+    # of each slot
+
+    k = len(counts)
+    total = sum(counts)
+    scaled = [c * k for c in counts]
+    prob = [1.0] * k
+    alias = list(range(0, k))
+    small = [j for j in range(0, k) if scaled[j] < total]
+    large = [j for j in range(0, k) if scaled[j] >= total]
+    while small and large:
+      s = small.pop()
+      l = large.pop()
+      prob[s] = scaled[s] / total
+      alias[s] = l
+      scaled[l] -= total - scaled[s]
+      if scaled[l] < total:
+        small.append(l)
+      else:
+        large.append(l)
+    return prob, alias
+
+  def merged(self):
+    # returns a new compiled table holding this table's rows plus the
+    # counts gathered since it was compiled (e.g. by addSequence)
+    # rows without new counts are copied over in bulk, rows with new
+    # counts are rebuilt, and new prefixes are appended as new rows
+    # this table is left as it is, so readers can keep using it
+    # until the new table is swapped in
+
+    table = TransitionTable(self.depth, self.sampling)
+    oldrows = len(self)
+    rows = dict(self.rows)
+    changed = {} # row -> {successor id: count}
+    for key, counts in self.counts.items():
+      row = rows.get(key)
+      succ = {}
+      if row is not None:
+        prev = 0
+        for i in range(self.rowstart[row], self.rowstart[row + 1]):
+          succ[self.successors[i]] = self.cumcounts[i] - prev
+          prev = self.cumcounts[i]
+      else:
+        row = rows[key] = len(rows)
+      for val, count in counts.items():
+        succ[val] = succ.get(val, 0) + count
+      changed[row] = succ
+
+    def copy(typecode, data, start, end):
+      return np.asarray(memoryview(data))[start:end].astype(
+        np.dtype(typecode))
+    aliased = self.sampling == 'alias'
+    parts = {'succ': [], 'cum': [], 'aprob': [], 'asucc': []}
+    lengths = np.zeros(len(rows), np.int64)
+    lengths[:oldrows] = np.diff(np.asarray(memoryview(self.rowstart)))
+    copied = 0 # old rows before this one have been copied
+    for row in sorted(changed) + [len(rows)]:
+      upto = min(row, oldrows)
+      if copied < upto:
+        start = self.rowstart[copied]
+        end = self.rowstart[upto]
+        parts['succ'].append(copy('I', self.successors, start, end))
+        parts['cum'].append(copy('I', self.cumcounts, start, end))
+        if aliased:
+          parts['aprob'].append(copy('d', self.aliasprob, start, end))
+          parts['asucc'].append(copy('I', self.aliassucc, start, end))
+      copied = max(copied, upto)
+      if row == len(rows):
+        break
+      succ = changed[row]
+      vals = list(succ.keys())
+      counts = list(succ.values())
+      lengths[row] = len(vals)
+      parts['succ'].append(np.array(vals, np.uint32))
+      parts['cum'].append(np.cumsum(counts).astype(np.uint32))
+      if aliased:
+        prob, alias = self.aliasRow(counts)
+        parts['aprob'].append(np.array(prob, np.float64))
+        parts['asucc'].append(np.array([vals[a] for a in alias], np.uint32))
+      if row < oldrows:
+        copied = row + 1
+
+    def join(typecode, pieces):
+      return array(typecode, np.concatenate(pieces + [
+        np.zeros(0, np.dtype(typecode))]).astype(np.dtype(typecode)).tobytes())
+    table.rows = rows
+    table.rowprefix = array('I', memoryview(self.rowprefix).tobytes())
+    for key in list(rows)[oldrows:]:
+      table.rowprefix.extend(self.splitKey(key))
+    table.rowstart = join('q', [np.zeros(1, np.int64), np.cumsum(lengths)])
+    table.successors = join('I', parts['succ'])
+    table.cumcounts = join('I', parts['cum'])
+    if aliased:
+      table.aliasprob = join('d', parts['aprob'])
+      table.aliassucc = join('I', parts['asucc'])
+    return table
+
+  def footprint(self):
+    # rough estimate of the memory the table takes, in bytes
+    # the flat arrays count in full (also when they are mapped from a
+    # snapshot), the dicts by their size plus that of their int keys
+
+    size = sum(arrayBytes(data) for data in [self.rowprefix,
+      self.rowstart, self.successors, self.cumcounts, self.aliasprob,
+      self.aliassucc, self.startcum])
+    size += sys.getsizeof(self.rows) + 2 * sys.getsizeof(1 << 62) * len(
+      self.rows)
+    size += sys.getsizeof(self.counts) + sum(sys.getsizeof(c) +
+      sys.getsizeof(1 << 62) for c in self.counts.values())
+    if self.batcharrays is not None:
+      size += sum(a.nbytes for a in self.batcharrays.values()
+        if a.flags.owndata)
+    return size
+
+  def sections(self, prefix):
+    # the arrays that make up a compiled table, for snapshots
+    # prefix: one character to keep the names of several tables apart
+
+    return [
+      (prefix + 'rowpref', self.rowprefix),
+      (prefix + 'rowstrt', self.rowstart),
+      (prefix + 'succ', self.successors),
+      (prefix + 'cum', self.cumcounts),
+    ] + ([
+      (prefix + 'aprob', self.aliasprob),
+      (prefix + 'asucc', self.aliassucc),
+    ] if self.aliasprob is not None else [])
+
+  def loadSections(self, prefix, sections):
+    # takes over the arrays of a compiled table from a snapshot
+    # the arrays may be read-only memoryviews into a mapped file
+    # only the rows dict is rebuilt, since it can not be mapped
+
+    self.rowprefix = sections[prefix + 'rowpref']
+    self.rowstart = sections[prefix + 'rowstrt']
+    self.successors = sections[prefix + 'succ']
+    self.cumcounts = sections[prefix + 'cum']
+    n = self.depth - 1
+    self.rows = {self.makeKey(self.rowprefix[r*n:(r+1)*n]): r
+      for r in range(0, len(self.rowstart) - 1)}
+    self.counts = {}
+    self.batcharrays = None
+    self.startcum = None
+    self.aliasprob = sections.get(prefix + 'aprob')
+    self.aliassucc = sections.get(prefix + 'asucc')
+    if self.sampling != 'alias':
+      self.aliasprob = self.aliassucc = None
+    elif self.aliasprob is None:
+      self.buildAliasTables()
+
+  def sample(self, key):
+    # draws a successor id for the prefix key, weighted by its count
+    # returns -1 if the prefix was never seen
+
+    row = self.rows.get(key)
+    if row is None:
+      return -1
+    start = self.rowstart[row]
+    end = self.rowstart[row + 1]
+    if self.aliasprob is not None:
+      r = random.random() * (end - start)
+      i = start + int(r)
+      if r - int(r) < self.aliasprob[i]:
+        return self.successors[i]
+      return self.aliassucc[i]
+    x = random.randrange(self.cumcounts[end - 1])
+    return self.successors[
+      bisect.bisect_right(self.cumcounts, x, start, end)]
+
+  def sampleStart(self):
+    # draws the prefix ids of a row, weighted by the row's total count
+    # this is the same as taking the prefix at a random position of 
+    # the corpus, without having to keep the corpus around
+
+    if self.startcum is None:
+      startcum = array('q')
+      total = 0
+      for row in range(0, len(self)):
+        total += self.cumcounts[self.rowstart[row + 1] - 1]
+        startcum.append(total)
+      self.startcum = startcum
+    row = bisect.bisect_right(self.startcum,
+      random.randrange(self.startcum[-1]))
+    n = self.depth - 1
+    return self.rowprefix[row*n:(row+1)*n]
+
+  def walk(self, seeds, steps):
+    # starting from the depth-1 ids in seeds, draws steps successors
+    # returns seeds followed by the drawn ids
+    # once a prefix has no successors, the walk yields -1 from then on
+    # the result list is allocated up front and the prefix is a rolling
+    # int key, so a step is one dict lookup and one draw
+
+    n = len(seeds)
+    ids = list(seeds) + [-1] * steps
+    key = self.makeKey(seeds)
+    keymask = self.keymask
+    sample = self.sample
+    for i in range(n, n + steps):
+      val = sample(key)
+      if val < 0:
+        break
+      ids[i] = val
+      key = ((key << KEYBITS) | val) & keymask
+    return ids
+
+  def getBatchArrays(self):
+    # numpy arrays used by sampleRows and walkMany, built once and cached:
+    #   rowstart, successors: numpy views on the table arrays
+    #   rowprefix: the prefix ids as a (rows, depth-1) matrix
+    #   globalcum: running count over all successors of all rows,
+    #     so one searchsorted can draw from many different rows
+    #   rowbase: globalcum before the first successor of each row
+    #   nextrow: for each successor slot, the row of the prefix that
+    #     follows when that successor is drawn, or -1 for a dead end
+    #     (only built once walkMany needs it)
+
+    if self.batcharrays is None:
+      rowstart = np.asarray(memoryview(self.rowstart)).astype(np.int64)
+      successors = np.asarray(memoryview(self.successors)).astype(np.int64)
+      counts = np.asarray(memoryview(self.cumcounts)).astype(np.int64)
+      counts[1:] -= counts[:-1].copy()
+      counts[rowstart[1:-1]] = np.asarray(
+        memoryview(self.cumcounts))[rowstart[1:-1]]
+      globalcum = np.cumsum(counts)
+      rowbase = np.concatenate(([0], globalcum))[rowstart]
+      self.batcharrays = {
+        'rowstart': rowstart,
+        'successors': successors,
+        'rowprefix': np.asarray(memoryview(self.rowprefix)).astype(
+          np.int64).reshape(len(self), self.depth - 1),
+        'globalcum': globalcum,
+        'rowbase': rowbase,
+      }
+    return self.batcharrays
+
+  def getNextRows(self):
+    # the nextrow array of getBatchArrays, built on first use
+
+    a = self.getBatchArrays()
+    if 'nextrow' not in a:
+      nextrow = np.full(len(a['successors']), -1, np.int64)
+      keymask = self.keymask
+      n = self.depth - 1
+      for row in range(0, len(self)):
+        key = (self.makeKey(self.rowprefix[row*n:(row+1)*n])
+          << KEYBITS) & keymask
+        for i in range(self.rowstart[row], self.rowstart[row + 1]):
+          nextrow[i] = self.rows.get(key | self.successors[i], -1)
+      a['nextrow'] = nextrow
+    return a['nextrow']
+
+  def sampleRows(self, rows, rng):
+    # draws one successor for each row index in the numpy array rows
+    # (all >= 0), weighted by count. returns the successor slots,
+    # i.e. indices into successors
+
+    a = self.getBatchArrays()
+    x = rng.integers(a['rowbase'][rows], a['rowbase'][rows + 1])
+    return np.searchsorted(a['globalcum'], x, side='right')
+
+  def walkMany(self, n, steps, rng = None):
+    # draws n walks of steps successors at once, in lock-step
+    # each walk starts at a row drawn by its total count, which is the
+    # same as starting at a random n-gram of the corpus
+    # returns an (n, depth-1+steps) int matrix of the seeds and the
+    # drawn ids, with -1 after a walk has hit a dead end
+
+    rng = np.random.default_rng() if rng is None else rng
+    a = self.getBatchArrays()
+    nextrow = self.getNextRows()
+    globalcum = a['globalcum']
+    ids = np.full((n, self.depth - 1 + steps), -1, np.int64)
+    if len(globalcum) == 0:
+      return ids
+
+    slots = np.searchsorted(globalcum,
+      rng.integers(0, globalcum[-1], n), side='right')
+    rows = np.searchsorted(a['rowstart'], slots, side='right') - 1
+    ids[:, :self.depth - 1] = a['rowprefix'][rows]
+
+    for t in range(self.depth - 1, self.depth - 1 + steps):
+      alive = np.flatnonzero(rows >= 0)
+      if len(alive) == 0:
+        break
+      slots = self.sampleRows(rows[alive], rng)
+      ids[alive, t] = a['successors'][slots]
+      rows[alive] = nextrow[slots]
+    return ids
+
+# ************************ MARKOV CHAIN *****************************
+
 class TextMarkovChain():
 
   # ************************ CONSTRUCTOR *****************************
 
   def __init__(self, 
     depth=3, 
-    text = None, textlist = None, filename = None, 
-    nlp = None):
+    text = None, textlist = None, filename = None, rows = None,
+    nlp = None, snapshot = None, checksum = None, sampling = 'alias',
+    keepwords = False):
     # initializes the markov chain text generator
     # parameters:
     #   - depth: how many words to use to look ahead to predict new words
-    #   - text/textlist/filename: 3 ways to give text to make a corpus
-    #     any one of them is sufficient. 
+    #   - text/textlist/filename/rows: 4 ways to give text to make a
+    #     corpus. any one of them is sufficient. 
     #     - text: one wall of text the words of which will be the corpus
-    #     - textlist: a list of all text strings to be used as a corpus
+    #     - textlist: a list (or any iterable) of all text strings 
+    #       to be used as a corpus
     #     - filename: a file to a textfile from which text will be read
+    #     - rows: an iterable of db rows, with the text in the first
+    #       column (as DBHelper.iter_items streams them), or of strings
+    #       each row is one quote or synopsis: the start and end of the
+    #       row and of each sentence in it are kept in the corpus as
+    #       STARTTOKEN and ENDTOKEN, see getRowBatches
     #   - nlp: spacy natural language processing pipeline (optional)
+    #   - snapshot: path to a snapshot file of this chain (optional)
+    #     together with filename: if the snapshot matches the
+    #     checksum of the file, depth and nlp usage, it is memory-mapped
+    #     instead of building the chain. else the chain is built and
+    #     the snapshot is (re)written
+    #     together with rows and checksum: the same, with checksum
+    #     (e.g. DBHelper.fingerprint) standing in for the file checksum
+    #     without any text: the snapshot is memory-mapped as it is, if
+    #     it matches the nlp usage (e.g. to reload a chain that was
+    #     written out with saveSnapshot before). snapshot may then also
+    #     be the bytes of a snapshot, see snapshotBytes
+    #   - sampling: 'alias' for constant time draws from the tables
+    #     (uses more memory), 'cumulative' for bisect draws
+    #   - keepwords: if True, keep the whole corpus as word ids in 
+    #     allwords (and as tag ids in alltags), e.g. to pass a seed 
+    #     to generateTextStd. else the corpus is streamed through the 
+    #     tables in batches and only the tables are kept
+    #
+    # words are stored as integer ids into self.vocab, so allwords
+    # is an array of ids rather than a list of strings
 
-    self.allwords = []
-
-    if filename is not None: # if we get passed a file, 
-      self.getTextFromFile(filename) # get corpus from file
-
-    if textlist is not None: # else if we get a list of texts, 
-      self.getTextFromTextList(textlist) # use those to build corpus
-
-    if text is not None: # else if we get a large block of text
-      self.allwords += text.split() # split it into words and use that
+    self.vocab = Vocabulary() # word <-> integer id
+    self.allwords = array('I') # the corpus as word ids, if kept
+    self.nwords = 0 # number of words in the corpus
+    self.keepwords = keepwords
+    self.snapshot = None # memory map of the loaded snapshot, if any
+    self.sampling = sampling # how to draw from the transition tables
+    self.updatelock = threading.Lock() # one update() at a time
+    self.slotvectors = None # (nlpdict, its slot vectors), see slotVectors
+    self.boundaries = rows is not None # corpus has boundary tokens
 
-    if self.allwords == []: # if our corpus is empty,
-      return # we can't do anything, so just abandon ship and return
+    if snapshot is not None and filename is not None:
+      checksum = fileChecksum(filename)
+      if self.loadSnapshot(snapshot, checksum, depth, nlp):
+        return
+    elif snapshot is not None and rows is not None:
+      if checksum is not None and self.loadSnapshot(snapshot, checksum,
+        depth, nlp):
+        return
+    elif snapshot is not None and text is None and textlist is None:
+      if self.loadSnapshot(snapshot, nlp = nlp):
+        return
 
     self.depth = depth # look-ahead depth to predict words with
     
     self.nlp = nlp # spacy natural language processing pipeline
 
-    self.chaintable = {} # dict with predictor word-keys and possible values
-    self.generateTable() # generate the prediction matrix
+    # prediction table on word ids
+    self.chaintable = TransitionTable(self.depth, self.sampling)
+    self.wordcarry = array('I') # last words of the previous batch
+
+    # tag id -> ids of the words used with that tag, with their counts
+    self.nlpdict = TransitionTable(2, self.sampling)
+    self.nlpvocab = Vocabulary() # words as tokenized by the nlp pipeline
+    self.tagvocab = Vocabulary() # spacy tag hash <-> integer id
+    # prediction table on tag ids
+    self.nlptable = TransitionTable(self.depth, self.sampling)
+    self.alltags = array('I') # the corpus as tag ids, if kept
+    self.tagcarry = array('I') # last tags of the previous batch
+    # unit word vectors of the words in nlpvocab, one row per word id
+    self.vectors = np.zeros((0, 0), np.float32)
 
-    self.nlpdict = {}
-    self.nlptable = {} # dict with predictor nlp tag keys and possible values 
-    self.allnlpwords = []
-    self.generateNLPData() # generate the nlp table
+    texts = []
+    if filename is not None: # if we get passed a file, 
+      texts = self.getTextFromFile(filename) # get corpus from file
+    elif textlist is not None: # else if we get a list of texts, 
+      texts = self.getTextFromTextList(textlist) # use those
+    elif text is not None: # else if we get a large block of text
+      texts = [text] # use the words in that
+    if rows is not None: # rows straight from the db
+      self.addBatches(self.getRowBatches(rows))
+      self.compileTables()
+    else:
+      self.generateTables(texts) # generate the prediction matrices
+
+    if snapshot is not None and checksum is not None:
+      self.saveSnapshot(snapshot, checksum)
 
   # ************************ INPUT PROCESSING *****************************
 
   def getTextFromTextList(self, textlist):
     # fetches all the text lines in the list of texts
-    # splits them up into individual words 
-    # and adds them to our list of allwords-dataset
 
     for text in textlist:
-      self.allwords += text.split()
+      yield text
 
   def getTextFromFile(self, filename):
-    # fetches all the text from a file, 
-    # splits them up into individual words 
-    # and adds them to our list of allwords-dataset
+    # fetches all the text from a file, line by line,
+    # so the file never has to be in memory as a whole
 
     with codecs.open(filename,'r',encoding='utf-8',errors='ignore') as f:
-      self.allwords += f.read().split()
+      for line in f:
+        yield line
+
+  def getWordBatches(self, texts, batchwords = BATCHWORDS):
+    # splits the texts up into individual words 
+    # and yields them in lists of about batchwords words
+
+    batch = []
+    for text in texts:
+      batch += text.split()
+      if len(batch) >= batchwords:
+        yield batch
+        batch = []
+    if len(batch) > 0:
+      yield batch
+
+  def getRowBatches(self, rows, batchwords = BATCHWORDS):
+    # splits the text of each row up into individual words, with each
+    # sentence in it between a STARTTOKEN and an ENDTOKEN, and yields
+    # them in lists of about batchwords words
+    # a quote without a full stop at its end still ends its sentence,
+    # and no n-gram runs from one quote into the next without passing
+    # the boundary tokens, so generated text starts and ends sentences
+    # where the quotes did
+
+    batch = []
+    for row in rows:
+      words = (row if isinstance(row, str) else row[0]).split()
+      if len(words) == 0:
+        continue
+      batch.append(STARTTOKEN)
+      for i, word in enumerate(words):
+        batch.append(word)
+        if i + 1 < len(words) and SENTENCEEND.search(word):
+          batch.append(ENDTOKEN)
+          batch.append(STARTTOKEN)
+      batch.append(ENDTOKEN)
+      if len(batch) >= batchwords:
+        yield batch
+        batch = []
+    if len(batch) > 0:
+      yield batch
 
   # ******************* MARKOV CHAIN GENERATION ************************
 
@@ -77,7 +707,7 @@ class TextMarkovChain():
     # get a tuple of length specified in our depth field
     # pulls the tuple sequentially from drawfrom until there are no more
     # this means drawfrom must be one of our allwords lists
-    # in our case: allwords, or allnlpwords
+    # in our case: allwords, or alltags
 
     if len(drawfrom) < self.depth:
       return
@@ -85,44 +715,336 @@ class TextMarkovChain():
     for i in range(0,len(drawfrom) - self.depth):
       yield [drawfrom[i+d] for d in range(0,self.depth)]
 
-  def generateTable(self):
-    # for each tuple with length l as specified in our depth field,
-    # use the first l-1 elements as a prediction-key
-    # and use the last element as the predicted value
+  def generateTables(self, texts):
+    # counts the texts into the tables, then packs all tables 
+    # and sets up the similarity index
+
+    self.addTexts(texts)
+    self.compileTables()
+
+  def addTexts(self, texts):
+    # streams the texts through the tables, see addBatches
+
+    self.addBatches(self.getWordBatches(texts))
+
+  def addBatches(self, wordbatches):
+    # streams the batches of words through the word table and, if we
+    # have an nlp pipeline, through the nlp tables, one batch at a time
+    # the nlp pipeline gets the batches through nlp.pipe, so it never
+    # has to parse one giant document
+
+    if self.nlp is not None:
+      batches = (' '.join(self.nlpWords(self.addWords(words)))
+        for words in wordbatches)
+      for doc in self.nlp.pipe(batches, batch_size = NLPBATCHES,
+        disable = NLPDISABLE):
+        self.addNLPDoc(doc)
+    else:
+      for words in wordbatches:
+        self.addWords(words)
+
+  def compileTables(self):
+    # packs the counts gathered by addWords and addNLPDoc into the
+    # tables used for text generation
 
-    for tup in self.getTuple(self.allwords):
-      val = tup[-1]
-      key = str(tup[0:-1])
-      if key in self.chaintable:
-        self.chaintable[key].append(val)
+    self.chaintable.compile()
+    if self.nlp is not None:
+      self.nlpdict.compile()
+      self.nlptable.compile()
+      self.generateVectorIndex()
+
+  def mergeTables(self):
+    # merges the counts gathered by addWords and addNLPDoc since the
+    # tables were compiled into new tables, and swaps those in
+    # vocabularies and vectors only grow, and are extended before 
+    # the tables are swapped, so a reader that got either the old or
+    # the new table finds every id it can draw
+
+    chaintable = self.chaintable.merged()
+    if self.nlp is not None:
+      nlpdict = self.nlpdict.merged()
+      nlptable = self.nlptable.merged()
+      self.generateVectorIndex()
+      self.nlpdict = nlpdict
+      self.nlptable = nlptable
+    self.chaintable = chaintable
+
+  def update(self, text):
+    # adds the words of text to the corpus of a live chain, as if 
+    # they had been appended to the original corpus
+
+    self.updateFromTextList([text])
+
+  def updateFromTextList(self, textlist):
+    # adds the texts in textlist to the corpus of a live chain
+    # only the new n-grams are counted and only the table rows they
+    # touch are rebuilt. generateText calls running at the same time
+    # keep using the old tables until the new ones are swapped in
+
+    with self.updatelock:
+      if not isinstance(self.allwords, array): # mapped from a snapshot
+        self.allwords = array('I', self.allwords.tobytes())
+        self.alltags = array('I', self.alltags.tobytes())
+      if self.boundaries:
+        self.addBatches(self.getRowBatches(textlist))
       else:
-        self.chaintable[key] = [val]
+        self.addTexts(self.getTextFromTextList(textlist))
+      self.mergeTables()
+
+  def addWords(self, words):
+    # encodes the given words as vocabulary ids and counts their
+    # n-grams in the word table. for each n-gram of depth words
+    # use the first depth-1 words as a prediction-key
+    # and count the last word as a predicted value
+    # the last depth words are carried over to the next batch, so 
+    # n-grams across batches are counted as well
+    # returns words, so batches can be passed on to the nlp pipeline
+
+    encode = self.vocab.encode
+    ids = array('I', [encode(w) for w in words])
+    self.nwords += len(ids)
+    if self.keepwords:
+      self.allwords.extend(ids)
+    self.wordcarry = self.addWithCarry(self.chaintable, self.wordcarry, ids)
+    return words
 
-  def generateNLPData(self):
+  def nlpWords(self, words):
+    # words without the boundary tokens, which only the word table knows
+
+    if self.boundaries:
+      return [w for w in words if w != STARTTOKEN and w != ENDTOKEN]
+    return words
+
+  def addNLPDoc(self, doc):
     # sets up the nlp data that we can use to generate text
-    # if our natural language pipeline processor is not None, we can setup
-    # first, it will process natural language analyses on all given words
-    # then, for all tags we have, we will create a list of possible words
-    # then, we setup our nlptable on nlp TAGS rather than the words
+    # for all tags in the processed doc, we count the words used with 
+    # them in nlpdict, and we count the n-grams of tags in nlptable
     # this way, we can create sentences based on nlp tags
     # and then drawing words to fill the nlp tags
 
-    if self.nlp is not None:
-      self.allnlpwords = self.nlp(' '.join(self.allwords))
-      
-      for word in self.allnlpwords:
-        if not word.tag in self.nlpdict:
-          self.nlpdict[word.tag] = []
-        self.nlpdict[word.tag].append(word.text)
-
-      for tup in self.getTuple(self.allnlpwords):
-        val = tup[-1]
-        key = tup[0:-1]
-        tagkey = str([k.tag for k in key])
-        if tagkey in self.chaintable:
-          self.nlptable[tagkey].append(val.tag)
-        else:
-          self.nlptable[tagkey] = [val.tag]
+    tags = array('I')
+    for word in doc:
+      tag = self.tagvocab.encode(word.tag)
+      tags.append(tag)
+      self.nlpdict.add(tag, self.nlpvocab.encode(word.text))
+    if self.keepwords:
+      self.alltags.extend(tags)
+    self.tagcarry = self.addWithCarry(self.nlptable, self.tagcarry, tags)
+
+  def addWithCarry(self, table, carry, ids):
+    # counts the n-grams of carry + ids in table and returns the new 
+    # carry: the last depth ids, whose last id has not been counted
+    # as a predicted value yet
+
+    seq = carry + ids
+    table.addSequence(seq)
+    return seq[-self.depth:]
+
+  def generateVectorIndex(self):
+    # sets up the similarity index used by Cartmanify
+    # each word in nlpvocab gets a row in self.vectors, holding its 
+    # normalized word vector (or zeros if the pipeline has no vector
+    # for it), so finding similar words is one matrix-vector product
+    # per tag instead of a pipeline call per word
+    # rows that are already there are kept, so after an update only
+    # the vectors of new words are looked up
+    # a pipeline without word vectors (such as en_core_web_sm) gives
+    # rows of length 0, for which similarWords finds no similar words
+
+    old = self.vectors
+    vocab = self.nlp.vocab
+    dim = old.shape[1] if len(old) > 0 else vocab.vectors_length
+    new = np.zeros((len(self.nlpvocab) - len(old), dim), np.float32)
+    if dim > 0 and dim == vocab.vectors_length:
+      for i in range(0, len(new)):
+        word = self.nlpvocab[len(old) + i]
+        if vocab.has_vector(word):
+          new[i] = vocab.get_vector(word)
+    norms = np.linalg.norm(new, axis=1)
+    new[norms > 0] /= norms[norms > 0, None]
+    self.vectors = np.concatenate([old.reshape(len(old), dim), new])
+
+  def similarWords(self, tag, vector, topn):
+    # returns up to topn of the words used with tag id tag that are
+    # most similar (cosine, > 0) to the word vector vector
+
+    nlpdict = self.nlpdict # before self.vectors, see mergeTables
+    vectors = self.slotVectors(nlpdict, self.vectors)
+    row = nlpdict.rows.get(tag)
+    if row is None:
+      return []
+    start = nlpdict.rowstart[row]
+    end = nlpdict.rowstart[row + 1]
+    norm = np.linalg.norm(vector) if len(vector) > 0 else 0
+    if end == start or norm == 0 or len(vector) != vectors.shape[1]:
+      return []
+    sims = vectors[start:end].dot(np.asarray(vector, np.float32) / norm)
+    topn = min(topn, len(sims))
+    top = np.argpartition(-sims, topn - 1)[:topn]
+    return [self.nlpvocab[nlpdict.successors[start + i]] for i in top
+      if sims[i] > 0]
+
+  def slotVectors(self, nlpdict, vectors):
+    # the word vectors of the successor slots of nlpdict, in slot order,
+    # so the words used with a tag are one contiguous slice of rows
+    # gathered from the per-word vectors once per nlpdict, i.e. after a
+    # build, snapshot load or update, and cached with the nlpdict they
+    # belong to, so a swapped in nlpdict gets its own
+
+    cached = self.slotvectors
+    if cached is None or cached[0] is not nlpdict:
+      successors = np.asarray(memoryview(nlpdict.successors), np.intp)
+      cached = (nlpdict, vectors[successors])
+      self.slotvectors = cached
+    return cached[1]
+
+  # ************************ SNAPSHOTS *****************************
+
+  def saveSnapshot(self, filename, checksum = ''):
+    # writes the vocabulary and tables to a binary snapshot file
+    # the file is written next to the target and then renamed over it,
+    # so processes that have the old snapshot mapped are not affected
+
+    tmpname = '{0}.{1}.tmp'.format(filename, os.getpid())
+    with open(tmpname, 'wb') as f:
+      self.writeSnapshot(f, checksum)
+    os.replace(tmpname, filename)
+
+  def snapshotBytes(self, checksum = ''):
+    # the snapshot of this chain as bytes, e.g. to hand a chain built in
+    # another process back compactly: TextMarkovChain(snapshot = data)
+
+    f = io.BytesIO()
+    self.writeSnapshot(f, checksum)
+    return f.getvalue()
+
+  def writeSnapshot(self, f, checksum = ''):
+    # writes the vocabulary and tables as a snapshot to binary file f
+    # layout: a header (magic, version, byte order marker, depth,
+    # nlp flag, checksum of the source corpus, number of sections)
+    # followed by a section table (name, typecode, offset, size)
+    # and then the raw bytes of each array, aligned to 8 bytes
+    # arrays are written in native byte order and item sizes, so a
+    # snapshot from another platform is simply rejected and rebuilt
+
+    vocaboff, vocabstr = packStrings(self.vocab.tokens)
+    nlpvoff, nlpvstr = packStrings(self.nlpvocab.tokens)
+    vectors = array('f')
+    vectors.frombytes(np.ascontiguousarray(self.vectors, np.float32).tobytes())
+    sections = [
+      ('vocaboff', vocaboff),
+      ('vocabstr', vocabstr),
+      ('nwords', array('q', [self.nwords])),
+      ('allwords', self.allwords),
+      ('tagvocab', array('Q', self.tagvocab.tokens)),
+      ('alltags', self.alltags),
+      ('nlpvoff', nlpvoff),
+      ('nlpvstr', nlpvstr),
+      ('vecdim', array('q', [self.vectors.shape[1]])),
+      ('vectors', vectors),
+    ] + (self.chaintable.sections('w') + self.nlptable.sections('t') +
+      self.nlpdict.sections('d'))
+
+    offset = SNAPSHOTHEADER.size + SNAPSHOTSECTION.size * len(sections)
+    table = []
+    for name, data in sections:
+      offset += -offset % 8
+      table.append(SNAPSHOTSECTION.pack(name.encode('ascii'),
+        typeCode(data).encode('ascii'), offset, len(data) * data.itemsize))
+      offset += len(data) * data.itemsize
+
+    start = f.tell()
+    f.write(SNAPSHOTHEADER.pack(SNAPSHOTMAGIC, SNAPSHOTVERSION,
+      SNAPSHOTBOM, self.depth, self.nlp is not None,
+      checksum.encode('ascii'), len(sections)))
+    f.write(b''.join(table))
+    for name, data in sections:
+      f.write(b'\0' * (-(f.tell() - start) % 8))
+      f.write(memoryview(data).cast('B'))
+
+  def loadSnapshot(self, filename, checksum = None, depth = None,
+    nlp = None):
+    # memory-maps a snapshot file written by saveSnapshot
+    # the arrays are used in place as read-only memoryviews, so
+    # several processes loading the same snapshot share its pages
+    # filename may also be the bytes of a snapshot (see snapshotBytes)
+    # which are then used in place the same way
+    # returns False, without changing the chain, if the file is
+    # missing or was written for another corpus checksum, depth,
+    # nlp usage, format version or platform
+
+    if isinstance(filename, (bytes, bytearray, memoryview)):
+      mm = filename
+    elif not os.path.isfile(filename):
+      return False
+    else:
+      with open(filename, 'rb') as f:
+        try:
+          mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+          return False
+    if len(mm) < SNAPSHOTHEADER.size:
+      if isinstance(mm, mmap.mmap):
+        mm.close()
+      return False
+    (magic, version, bom, sdepth, hasnlp, schecksum,
+      nsections) = SNAPSHOTHEADER.unpack_from(mm, 0)
+    if (magic != SNAPSHOTMAGIC or version != SNAPSHOTVERSION or
+      bom != SNAPSHOTBOM or
+      (depth is not None and sdepth != depth) or
+      bool(hasnlp) != (nlp is not None) or
+      (checksum is not None and
+        schecksum.rstrip(b'\0').decode('ascii') != checksum)):
+      if isinstance(mm, mmap.mmap):
+        mm.close()
+      return False
+
+    view = memoryview(mm)
+    sections = {}
+    for i in range(0, nsections):
+      name, typecode, offset, size = SNAPSHOTSECTION.unpack_from(mm,
+        SNAPSHOTHEADER.size + i * SNAPSHOTSECTION.size)
+      sections[name.rstrip(b'\0').decode('ascii')] = view[
+        offset:offset + size].cast(typecode.decode('ascii'))
+
+    self.snapshot = mm
+    self.depth = sdepth
+    self.nlp = nlp
+    self.vocab = Vocabulary(
+      unpackStrings(sections['vocaboff'], sections['vocabstr']))
+    self.allwords = sections['allwords']
+    self.nwords = sections['nwords'][0]
+    self.keepwords = len(self.allwords) > 0
+    self.chaintable = TransitionTable(self.depth, self.sampling)
+    self.chaintable.loadSections('w', sections)
+
+    self.tagvocab = Vocabulary(sections['tagvocab'])
+    self.alltags = sections['alltags']
+    self.nlpvocab = Vocabulary(
+      unpackStrings(sections['nlpvoff'], sections['nlpvstr']))
+    self.nlpdict = TransitionTable(2, self.sampling)
+    self.nlpdict.loadSections('d', sections)
+    self.nlptable = TransitionTable(self.depth, self.sampling)
+    self.nlptable.loadSections('t', sections)
+    self.vectors = np.frombuffer(sections['vectors'], np.float32).reshape(
+      len(self.nlpvocab), sections['vecdim'][0])
+    self.wordcarry = array('I')
+    self.tagcarry = array('I')
+    self.boundaries = STARTTOKEN in self.vocab
+    return True
+
+  def footprint(self):
+    # rough estimate of the memory this chain takes, in bytes
+    # (the vocabularies, tables, kept corpus and word vectors)
+
+    size = sum(arrayBytes(data) for data in [self.allwords, self.alltags,
+      self.wordcarry, self.tagcarry])
+    size += sum(table.footprint() for table in [self.chaintable,
+      self.nlptable, self.nlpdict])
+    size += sum(vocab.footprint() for vocab in [self.vocab,
+      self.nlpvocab, self.tagvocab])
+    size += 0 if self.slotvectors is None else self.slotvectors[1].nbytes
+    return size + self.vectors.nbytes
 
   # ************************ TEXT GENERATION *****************************
 
@@ -138,6 +1060,13 @@ class TextMarkovChain():
     else:
       return self.generateTextNLP(textlength, fullsentences)
 
+  def walkLength(self, textlength):
+    # how many words to draw from a table for a text of textlength
+    # and how many of the walked words end up in the text
+
+    steps = max(0, textlength - self.depth - 1)
+    return steps, steps + self.depth - 2
+
   def generateTextNLP(self, textlength = 30, fullsentences = True):
     # this will generate text working from POS tags rather than words
     # first creating a markov chain of pos tags
@@ -148,8 +1077,8 @@ class TextMarkovChain():
     # if it worked... it kind of does. I'm just not sure how much better
     # if at all.
     #
-    # choose a random index to use as the first word-tag
-    # then, use the depth-1 words starting from that index as a predictor
+    # choose a random tag prefix, weighted by how often it occurs
+    # (i.e. the depth-1 tags at a random index) as a predictor
     # get a random predicted value from our nlptable
     # then, 'forget' the first tag of the predictor seed
     # and store the new-predicted value into the new predictor seed set
@@ -157,27 +1086,20 @@ class TextMarkovChain():
     # then, if fullsentences is set to True,
     # remove half-sentences at the beginning and end of the generated text
 
-    firstwordindex = random.randint(0, len(self.allnlpwords)-self.depth-1)
-    seeds = [self.allnlpwords[firstwordindex + c] 
-      for c in range(0,self.depth-1)]
-    seeds = [s.tag for s in seeds]
-    tags = []
-    text = []
-    for i in range(textlength-self.depth-1):
-      #print(i,seeds)
-      tags.append(seeds[0])
-      seeds = []+seeds[1:]+[random.choice(self.chaintable[str(seeds)].tag)]
-    tags = tags + seeds[1:]
-    for tag in tags:
-      text = text + [random.choice(self.nlpdict[tag])]
+    seeds = self.nlptable.sampleStart()
+    steps, length = self.walkLength(textlength)
+    tags = self.nlptable.walk(seeds, steps)[:length]
+    text = [self.nlpvocab[self.nlpdict.sample(tag)] if tag >= 0 else ''
+      for tag in tags]
     text = ' '.join(text)
     if fullsentences:
       text = self.stripToFullSentences(text)
     return text
 
   def generateTextStd(self, textlength = 30, fullsentences = True, seed = None):
-    # choose a random index to use as the first word
-    # then, use the depth-1 words starting from that index as a predictor
+    # choose a random word prefix, weighted by how often it occurs
+    # (i.e. the depth-1 words at a random index) as a predictor
+    # or, if seed is given and we kept allwords, the words at index seed
     # get a random predicted value from our wordchaintable
     # then, 'forget' the first word of the predictor seed
     # and store the new-predicted value into the new predictor seed set
@@ -185,23 +1107,52 @@ class TextMarkovChain():
     # then, if fullsentences is set to True,
     # remove half-sentences at the beginning and end of the generated text
 
-    firstwordindex = random.randint(0, len(self.allwords)-self.depth-1)
-    firstwordindex = firstwordindex if seed == None else seed
-    seeds = [self.allwords[firstwordindex + c] for c in range(0,self.depth-1)]
-    text = []
-    for i in range(textlength-self.depth-1):
-      #print(i,seeds)
-      text.append(seeds[0])
-      seeds = [] + seeds[1:] + [
-      random.choice(self.chaintable[str(seeds)]) if str(seeds) in self.chaintable 
-      else ''
-      ]
-    text = text + seeds[1:]
-    text = ' '.join(text)
+    if seed is not None and seed + self.depth - 1 <= len(self.allwords):
+      seeds = self.allwords[seed:seed+self.depth-1]
+    else:
+      seeds = self.chaintable.sampleStart()
+    steps, length = self.walkLength(textlength)
+    ids = self.chaintable.walk(seeds, steps)[:length]
+    text = [self.vocab[i] if i >= 0 else '' for i in ids]
+    text = self.joinWords(text)
     if fullsentences:
       text = self.stripToFullSentences(text)
     return text
 
+  def generateTexts(self, n, textlength = 30, fullsentences = True,
+    usenlp = False, rng = None):
+    # generates n texts at once, the same way as generateText would
+    # all texts are advanced in lock-step over the transition tables
+    # with numpy, which is much faster than n calls to generateText
+    # rng: optional numpy random generator, for reproducible batches
+
+    rng = np.random.default_rng() if rng is None else rng
+    steps, length = self.walkLength(textlength)
+
+    if not usenlp:
+      ids = self.chaintable.walkMany(n, steps, rng)[:, :length]
+      words = np.array(self.vocab.tokens + [''], dtype=object)[ids]
+    else:
+      tags = self.nlptable.walkMany(n, steps, rng)[:, :length]
+      # fill each tag with a word drawn from its nlpdict row
+      # dead ends (-1) keep word id -1, which indexes the trailing ''
+      tagrows = np.array([self.nlpdict.rows.get(tag, -1)
+        for tag in range(0, len(self.tagvocab))] + [-1], np.int64)
+      rows = tagrows[tags]
+      wordids = np.full(tags.shape, -1, np.int64)
+      filled = rows >= 0
+      wordids[filled] = self.nlpdict.getBatchArrays()['successors'][
+        self.nlpdict.sampleRows(rows[filled], rng)]
+      words = np.array(self.nlpvocab.tokens + [''], dtype=object)[wordids]
+
+    texts = []
+    for row in words:
+      text = self.joinWords(row) if not usenlp else ' '.join(row)
+      if fullsentences:
+        text = self.stripToFullSentences(text)
+      texts.append(text)
+    return texts
+
   def Cartmanify(self, giventext, textlength = 30, fullsentences = True,
     useTopN = 2):
     # given a text giventext, will adjust the text by nlp tags
@@ -212,23 +1163,21 @@ class TextMarkovChain():
     # front and back of the returned text
     # useTopN will only use the top N words as found in the similarity 
     # search for synonym detection (else you can get weird sentences)
+    # giventext can also be a list of already parsed tokens, which are
+    # then used as they are instead of parsing the text again
 
     if self.nlp is None:
-      return giventext
+      return giventext if isinstance(giventext, str) \
+        else ' '.join(str(d) for d in giventext)
     else:
       text = []
-      doc = self.nlp(giventext)
+      doc = self.nlp(giventext, disable = NLPDISABLE) \
+        if isinstance(giventext, str) else giventext
       for d in doc:
-        tag = d.tag
-        if tag in self.nlpdict:
-          mostsimilar = [str(d)]
-          mostsimilarval = 0
-          for n in self.nlpdict[tag]:
-            sim = d.similarity(self.nlp(n))
-            if sim > mostsimilarval:
-              mostsimilarval = sim
-              mostsimilar.append(str(n))
-          mostsimilar = list(reversed(mostsimilar))[:useTopN]
+        tag = self.tagvocab.get(d.tag)
+        mostsimilar = self.similarWords(tag, d.vector, useTopN) \
+          if tag >= 0 else []
+        if len(mostsimilar) > 0:
           text.append(mostsimilar[random.randrange(0,len(mostsimilar))])
         else:
           text.append(str(d))
@@ -237,6 +1186,23 @@ class TextMarkovChain():
         text = self.stripToFullSentences(text)
       return text
 
+  def joinWords(self, words):
+    # joins generated words into a text
+    # the boundary tokens are left out, and an ENDTOKEN gives the
+    # sentence before it a full stop if it has none, so
+    # stripToFullSentences sees it end
+
+    if not self.boundaries:
+      return ' '.join(words)
+    text = []
+    for word in words:
+      if word == ENDTOKEN:
+        if len(text) > 0 and not SENTENCEEND.search(text[-1]):
+          text[-1] += '.'
+      elif word != STARTTOKEN and word != '':
+        text.append(word)
+    return ' '.join(text)
+
   def stripToFullSentences(self, text):
     # removes half-sentences at the beginning and end of the generated text
 
@@ -0,0 +1,209 @@
+# asyncio runner for the telegram chatbot
+#
+# long-polls the telegram bot api for updates and hands them to the
+# chatbot model concurrently, instead of one after the other:
+# - getUpdates uses the api's timeout parameter (long polling), so new
+#   messages come in as soon as they are sent, without a sleep loop
+# - all http calls share one pooled requests session
+# - messages of different chats are answered concurrently, messages
+#   of the same chat are answered in the order they came in
+# - at most max_inflight messages are being answered at any one time
+# - on SIGINT (Ctrl-C) or stop(), polling stops right away, and the
+#   messages being answered are still answered before run() returns
+#
+# the bot api url is a parameter, so the runner can be pointed at a
+# local stub server that mimics the bot api
+
+# ************************ IMPORTS ********************************
+
+import asyncio
+import functools
+import signal
+import sys
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# ************************ RUNNER ********************************
+
+class AsyncBot:
+
+    def __init__(self, model, url, poll_timeout=30, max_inflight=8):
+        # model: chatbot model, see Model.respond
+        # url: bot api url, i.e. https://api.telegram.org/bot<token>/
+        # poll_timeout: seconds a getUpdates call may wait for updates
+        # max_inflight: maximum number of messages answered at once
+
+        self.model = model
+        self.url = url
+        self.poll_timeout = poll_timeout
+        self.max_inflight = max_inflight
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_inflight + 1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # model calls and sendMessage calls run on these threads
+        self.executor = ThreadPoolExecutor(max_workers=max_inflight)
+        self.chats = {} # chat id -> messages waiting, while it has a worker
+        self.workers = set() # running chat worker tasks
+        self.inflight = None # semaphore, created in run()
+        self.offset = None # id of the next update to fetch
+        self.poll = None # future of the getUpdates call in progress
+        self.running = False
+
+    # ************************ BOT API ********************************
+
+    def api(self, method, params, http_timeout=10):
+        # calls a bot api method (blocking) and returns its json reply
+
+        response = self.session.get(self.url + method, params=params,
+                                    timeout=http_timeout)
+        return response.json()
+
+    def send_message(self, text, chat_id, reply_markup=None):
+        print('response: ' + text[slice(0,56)].strip().replace('\n',' ') + '...')
+        params = {'text': text, 'chat_id': chat_id, 'parse_mode': 'Markdown'}
+        if reply_markup:
+            params['reply_markup'] = reply_markup
+        return self.api('sendMessage', params)
+
+    async def call(self, fn, *args, **kwargs):
+        # runs a blocking function on the executor
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def get_updates(self):
+        # the long poll runs on a daemon thread of its own, not on the
+        # executor: stop() abandons it instead of waiting for it to
+        # return, and it does not keep the interpreter from exiting
+        # (updates it may still fetch are not confirmed by a next call
+        # with their offset, so telegram sends them again next time)
+
+        params = {'timeout': self.poll_timeout}
+        if self.offset:
+            params['offset'] = self.offset
+        loop = asyncio.get_running_loop()
+        self.poll = loop.create_future()
+
+        def settle(future, result, error):
+            if not future.done():
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+        def poll(future):
+            result, error = None, None
+            try:
+                result = self.api('getUpdates', params,
+                                  http_timeout=self.poll_timeout + 10)
+            except Exception as e:
+                error = e
+            try:
+                loop.call_soon_threadsafe(settle, future, result, error)
+            except RuntimeError:
+                pass # the loop was closed meanwhile
+
+        threading.Thread(target=poll, args=(self.poll,), daemon=True,
+                         name='AsyncBot-poll').start()
+        try:
+            return await self.poll
+        finally:
+            self.poll = None
+
+    # ************************ DISPATCH ********************************
+
+    def dispatch(self, update):
+        # queues the message of an update with its chat, and starts a
+        # worker for the chat if it does not have one running yet
+
+        message = update.get('message')
+        if message is None or 'text' not in message:
+            return
+        chat = message['chat']['id']
+        if chat in self.chats:
+            self.chats[chat].append(message)
+            return
+        self.chats[chat] = deque([message])
+        task = asyncio.ensure_future(self.chat_worker(chat))
+        self.workers.add(task)
+        task.add_done_callback(self.workers.discard)
+
+    async def chat_worker(self, chat):
+        # answers the messages of one chat one after the other
+        # a message stays in the queue until it has been answered, so
+        # dispatch keeps appending to this worker's queue meanwhile
+
+        queue = self.chats[chat]
+        while queue:
+            try:
+                await self.handle(queue[0])
+            except Exception as e:
+                print(type(e), e, e.args)
+                traceback.print_exc(file=sys.stdout)
+            queue.popleft()
+        del self.chats[chat]
+
+    async def handle(self, message):
+        text = message['text']
+        chat = message['chat']['id']
+        async with self.inflight:
+            (response, chat, reply_markup) = await self.call(
+                self.model.respond, text, chat)
+            if response is not None:
+                await self.call(self.send_message, response, chat,
+                                reply_markup)
+
+    # ************************ MAIN LOOP ********************************
+
+    async def run(self):
+        # polls for updates and dispatches them until stop() is called
+        # (also on SIGINT, where the loop supports signal handlers)
+        # then waits for the messages that are still being answered,
+        # and shuts down the executor
+
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGINT, self.stop)
+            handled = True
+        except (NotImplementedError, RuntimeError):
+            handled = False # windows, or not in the main thread
+        self.inflight = asyncio.Semaphore(self.max_inflight)
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    updates = await self.get_updates()
+                except asyncio.CancelledError:
+                    if self.running:
+                        raise
+                    break # abandoned by stop()
+                except Exception as e:
+                    print(type(e), e, e.args)
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates.get('result', []):
+                    self.offset = int(update['update_id']) + 1
+                    self.dispatch(update)
+            if self.workers:
+                print('answering {0} chats before stopping'.format(
+                    len(self.workers)))
+                await asyncio.gather(*self.workers)
+        finally:
+            if handled:
+                loop.remove_signal_handler(signal.SIGINT)
+            self.executor.shutdown(wait=False)
+
+    def stop(self):
+        # stops polling: the getUpdates call in progress is abandoned
+        # must be called from the thread running the event loop
+
+        self.running = False
+        if self.poll is not None:
+            self.poll.cancel()
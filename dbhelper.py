@@ -5,44 +5,319 @@
 # https://www.codementor.io/garethdwyer/building-a-telegram-bot-using-python-part-1-goi5fncay
 # https://github.com/sixhobbits/python-telegram-tutorial
 
+import os
+import random
 import sqlite3
+import threading
+import time
+from array import array
+from urllib.parse import quote
 
 class DBHelper:
 
-    def __init__(self, dbname="db.sqlite",journal_mode='OFF'):
+    def __init__(self, dbname="db.sqlite", journal_mode='WAL', readonly=False):
+        # one connection is used for writes, guarded by a lock so any
+        # thread may write
+        # reads go through one read-only connection per thread, which
+        # in WAL mode do not block on, or get blocked by, the writer
+        # readonly: if True, the db is never written to (not even to
+        # set the journal mode), e.g. for worker processes
         self.dbname = dbname
-        self.conn = sqlite3.connect(dbname)
-        self.conn.execute("PRAGMA journal_mode={0}".format(journal_mode))
+        self.readonly = readonly
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        if readonly:
+            self.conn = self.connect_readonly()
+        else:
+            self.conn = sqlite3.connect(dbname, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode={0}".format(journal_mode))
+        # owner -> rowids of their items, for random access by position
+        # loaded per owner on first use, dropped when the db changes
+        # rowids_version: the change counter they are current with
+        self.rowids = {}
+        self.rowids_version = None
+
+    def connect_readonly(self):
+        uri = 'file:{0}?mode=ro'.format(quote(os.path.abspath(self.dbname)))
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def reader(self):
+        # the read-only connection of the calling thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.connect_readonly()
+            self.local.conn = conn
+        return conn
+
+    def close(self):
+        # closes the write connection and the calling thread's reader
+        # readers of other threads are closed when their thread ends
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+        with self.lock:
+            self.conn.close()
 
     def setup(self):
-        tblstmt = "CREATE TABLE IF NOT EXISTS items (description text, owner text)"
+        # items: the quotes or synopses (description) per character or
+        # episode (owner), and the page they were extracted from (source)
+        # manifest: the hash of each source page as last extracted, and
+        # when, so only new or changed pages are extracted again
+        # changes: a counter bumped by every write to items, see fingerprint
+        tblstmt = "CREATE TABLE IF NOT EXISTS items (description text, owner text, source text)"
+        mfststmt = "CREATE TABLE IF NOT EXISTS manifest (source text PRIMARY KEY, hash text, processed real)"
+        chgstmt = "CREATE TABLE IF NOT EXISTS changes (name text PRIMARY KEY, count integer)"
+        with self.lock:
+            self.conn.execute(tblstmt)
+            columns = [x[1] for x in self.conn.execute("PRAGMA table_info(items)")]
+            if 'source' not in columns: # db from before the manifest
+                self.conn.execute("ALTER TABLE items ADD COLUMN source text")
+            self.conn.execute(mfststmt)
+            self.conn.execute(chgstmt)
+            self.conn.execute("INSERT OR IGNORE INTO changes (name, count) VALUES ('items', 0)")
+            self.create_indexes()
+            self.conn.commit()
+
+    def create_indexes(self):
         itemidx = "CREATE INDEX IF NOT EXISTS itemIndex ON items (description ASC)" 
         ownidx = "CREATE INDEX IF NOT EXISTS ownIndex ON items (owner ASC)"
-        self.conn.execute(tblstmt)
-        self.conn.execute(itemidx)
-        self.conn.execute(ownidx)
-        self.conn.commit()
+        srcidx = "CREATE INDEX IF NOT EXISTS sourceIndex ON items (source ASC)"
+        with self.lock:
+            self.conn.execute(itemidx)
+            self.conn.execute(ownidx)
+            self.conn.execute(srcidx)
+
+    def drop_indexes(self):
+        with self.lock:
+            self.conn.execute("DROP INDEX IF EXISTS itemIndex")
+            self.conn.execute("DROP INDEX IF EXISTS ownIndex")
+
+    def count_change(self):
+        # bumps the change counter of the items, in the transaction of
+        # the write (call with the lock held), and returns its new value
+        self.conn.execute("UPDATE changes SET count = count + 1 WHERE name = 'items'")
+        return self.conn.execute("SELECT count FROM changes WHERE name = 'items'").fetchone()[0]
+
+    def keep_rowids(self, version):
+        # after a write that updated the cached rowids itself, committed
+        # as version of the change counter (call with the lock held):
+        # they are current with it, if they were current right before
+        if self.rowids_version != version - 1:
+            self.rowids = {}
+        self.rowids_version = version
 
     def add_item(self, item_text, owner):
         stmt = "INSERT INTO items (description, owner) VALUES (?, ?)"
         args = (item_text, owner)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        with self.lock:
+            rowid = self.conn.execute(stmt, args).lastrowid
+            version = self.count_change()
+            self.conn.commit()
+            if owner in self.rowids:
+                self.rowids[owner].append(rowid)
+            self.keep_rowids(version)
+
+    def add_items(self, items):
+        # adds all (item_text, owner) pairs of the iterable items
+        # in a single transaction: all of them are added, or none
+        stmt = "INSERT INTO items (description, owner) VALUES (?, ?)"
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(stmt, items)
+                self.count_change()
+            self.rowids = {}
+
+    def bulk_load(self, sources):
+        # full reload: replaces all items extracted from pages, and the
+        # manifest, by those of sources, in a single transaction
+        # sources: iterable of (source, hash, items) as in replace_sources
+        #   (may be a generator: its rows are inserted as they come)
+        # duplicate (item_text, owner) pairs are removed across the whole
+        # load (the first one is kept), and the indexes are dropped during
+        # the load and built again after. sqlite3 only opens its own
+        # transaction before an insert, so it is begun here: a load that
+        # fails rolls back the dropped indexes as well
+        # a pair found on several pages is kept under the first of them
+        # only: should a later replace_sources of that page no longer
+        # have it, the pair is gone until the next full reload
+        # returns the number of rows inserted
+        stmt = "INSERT INTO items (description, owner, source) VALUES (?, ?, ?)"
+        mfststmt = "INSERT INTO manifest (source, hash, processed) VALUES (?, ?, ?)"
+        processed = time.time()
+        seen = set()
+        manifest = []
+        def unique():
+            for source, content_hash, items in sources:
+                manifest.append((source, content_hash, processed))
+                for item_text, owner in items:
+                    if (item_text, owner) not in seen:
+                        seen.add((item_text, owner))
+                        yield (item_text, owner, source)
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.drop_indexes()
+                self.conn.execute("DELETE FROM items WHERE source IS NOT NULL")
+                self.conn.execute("DELETE FROM manifest")
+                self.conn.executemany(stmt, unique())
+                self.conn.executemany(mfststmt, manifest)
+                self.create_indexes()
+                self.count_change()
+            self.rowids = {}
+        return len(seen)
+
+    def get_manifest(self):
+        # source -> (hash, time processed) of all extracted pages
+        stmt = "SELECT source, hash, processed FROM manifest"
+        return {x[0]: (x[1], x[2]) for x in self.reader().execute(stmt)}
+
+    def replace_sources(self, sources):
+        # sources: list of (source, hash, items), items being the
+        # (item_text, owner) pairs extracted from the page source
+        # replaces the items of each source by the given ones (without
+        # duplicate pairs) and records its hash in the manifest, all in
+        # a single transaction, so it either all happens or none of it
+        # a pair found on several pages is kept once per page: otherwise
+        # re-extracting one of them could delete a pair the others have
+        # returns the number of rows inserted
+        delstmt = "DELETE FROM items WHERE source = (?)"
+        stmt = "INSERT INTO items (description, owner, source) VALUES (?, ?, ?)"
+        mfststmt = "INSERT OR REPLACE INTO manifest (source, hash, processed) VALUES (?, ?, ?)"
+        processed = time.time()
+        inserted = 0
+        with self.lock:
+            with self.conn:
+                for source, content_hash, items in sources:
+                    rows = [(item_text, owner, source) for item_text, owner in dict.fromkeys(items)]
+                    self.conn.execute(delstmt, (source, ))
+                    self.conn.executemany(stmt, rows)
+                    self.conn.execute(mfststmt, (source, content_hash, processed))
+                    inserted += len(rows)
+                self.count_change()
+            self.rowids = {}
+        return inserted
+
+    def drop_unsourced_duplicates(self):
+        # deletes the items without a source page whose (item_text, owner)
+        # pair was also extracted from a page, i.e. the rows of a db from
+        # before the manifest that have been extracted again since, so
+        # those are not in the db twice. rows without a source that no
+        # page has (such as quotes added by the bot) are kept
+        # returns the number of rows deleted
+        stmt = ("DELETE FROM items WHERE source IS NULL AND EXISTS "
+                "(SELECT 1 FROM items AS page WHERE page.source IS NOT NULL "
+                "AND page.description = items.description AND page.owner = items.owner)")
+        with self.lock:
+            with self.conn:
+                deleted = self.conn.execute(stmt).rowcount
+                if deleted > 0:
+                    self.count_change()
+            if deleted > 0:
+                self.rowids = {}
+        return deleted
 
     def delete_item(self, item_text, owner):
         stmt = "DELETE FROM items WHERE description = (?) AND owner = (?)"
         args = (item_text, owner )
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        with self.lock:
+            self.conn.execute(stmt, args)
+            version = self.count_change()
+            self.conn.commit()
+            self.rowids.pop(owner, None)
+            self.keep_rowids(version)
 
     def get_items(self, owner):
         stmt = "SELECT description FROM items WHERE owner = (?)"
         args = (owner, )
-        return [x[0] for x in self.conn.execute(stmt, args)]
+        return [x[0] for x in self.reader().execute(stmt, args)]
+
+    def iter_items(self, owner=None, batchsize=1000):
+        # streams the (item_text, owner) pairs of owner (or of all
+        # owners, if None) in the order they were added, so each page's
+        # quotes come out together and in order. the rows are stepped
+        # through by the cursor and fetched batchsize at a time, so
+        # they never have to be in memory all at once
+        if owner is None:
+            cursor = self.reader().execute("SELECT description, owner FROM items ORDER BY rowid")
+        else:
+            cursor = self.reader().execute("SELECT description, owner FROM items WHERE owner = (?) ORDER BY rowid", (owner, ))
+        try:
+            rows = cursor.fetchmany(batchsize)
+            while rows:
+                yield from rows
+                rows = cursor.fetchmany(batchsize)
+        finally:
+            cursor.close()
+
+    def fingerprint(self, owner=None):
+        # a string that changes when the items (of owner) change, e.g. to
+        # tell whether a snapshot of a chain built from them is current,
+        # without reading the rows: the change counter of the items (so
+        # also a same-length edit of a page is noticed), and their number
+        # and last rowid, for writes that did not go through DBHelper
+        # any write changes it, also one to the items of another owner
+        stmt = "SELECT COUNT(*), MAX(rowid) FROM items"
+        if owner is None:
+            row = self.reader().execute(stmt).fetchone()
+        else:
+            row = self.reader().execute(stmt + " WHERE owner = (?)", (owner, )).fetchone()
+        return 'items:{0}:{1}:{2}'.format(self.change_count(), *row)
+
+    def owner_rowids(self, owner):
+        # the rowids of the items of owner, as a compact array
+        # (8 bytes per item), so an item can be picked by position
+        # the cached arrays are dropped when the items were changed
+        # through another DBHelper (or process), as rowids may have been
+        # reused. that check reads the change counter through the
+        # thread's reader, without the lock: only loading an array does
+        # take it, so no write can slip in between reading and caching
+        version = self.change_count()
+        if version == self.rowids_version:
+            rowids = self.rowids.get(owner)
+            if rowids is not None:
+                return rowids
+        with self.lock:
+            version = self.change_count()
+            if version != self.rowids_version:
+                self.rowids = {}
+                self.rowids_version = version
+            rowids = self.rowids.get(owner)
+            if rowids is None:
+                stmt = "SELECT rowid FROM items WHERE owner = (?)"
+                rowids = array('q', [x[0] for x in self.reader().execute(stmt, (owner, ))])
+                self.rowids[owner] = rowids
+            return rowids
+
+    def count(self, owner):
+        return len(self.owner_rowids(owner))
+
+    def random_item(self, owner):
+        # a random item of owner (or None if they have none), fetched
+        # by rowid, without reading all of their items
+        rowids = self.owner_rowids(owner)
+        if len(rowids) == 0:
+            return None
+        stmt = "SELECT description FROM items WHERE rowid = (?)"
+        args = (rowids[random.randrange(0, len(rowids))], )
+        row = self.reader().execute(stmt, args).fetchone()
+        return None if row is None else row[0]
 
     def get_keys(self):
         stmt = "SELECT owner FROM items"
-        return list(set([x[0] for x in self.conn.execute(stmt)]))
+        return list(set([x[0] for x in self.reader().execute(stmt)]))
+
+    def get_key_counts(self):
+        # (owner, number of items) of all owners, most items first
+        stmt = "SELECT owner, COUNT(*) FROM items GROUP BY owner ORDER BY COUNT(*) DESC"
+        return list(self.reader().execute(stmt))
+
+    def change_count(self):
+        # the change counter of the items, bumped by every write to them
+        # through a DBHelper, of any process (see count_change)
+        # read through the thread's reader, so it never waits for writes
+        row = self.reader().execute("SELECT count FROM changes WHERE name = 'items'").fetchone()
+        return 0 if row is None else row[0]
 
     
             
@@ -0,0 +1,195 @@
+import re
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup, SoupStrainer
+from PageStore import PageStore
+
+# extraction of quotes and synopses from the web pages of the south park
+# wikia crawled into a PageStore archive, as used by
+# processScriptsFromHTML and processSynopsisFromHTML
+# pages are parsed in a pool of worker processes, each reading the
+# pages it parses straight from the archive, and their rows are
+# handed back one page at a time, so they can be written to the
+# database while the other pages are still being parsed
+#
+# with ingest, only pages that are new or changed since they were last
+# extracted (as recorded in the db's manifest) are extracted again
+#
+# scripts using extract_pages or ingest must only start the extraction
+# under if __name__ == '__main__': as the workers import the script
+# again on platforms that do not fork
+
+try:
+  import lxml # much faster than python's own html.parser
+  PARSER = 'lxml'
+except ImportError:
+  PARSER = 'html.parser'
+
+bracketpatterns = {} # brackets -> compiled pattern matching any of them
+
+def remove_text_inside_brackets(text, brackets="()[]"):
+  # removes the brackets in text, and all text inside them (nested)
+  # same result as the character by character version this replaces,
+  # but only the brackets are looked at one by one: the text between
+  # them is copied over in slices, so it runs in linear time in C
+
+  pattern = bracketpatterns.get(brackets)
+  if pattern is None:
+    pattern = re.compile('[{0}]'.format(re.escape(brackets)))
+    bracketpatterns[brackets] = pattern
+  count = [0] * (len(brackets) // 2) # count open/close brackets
+  saved = []
+  last = 0
+  for m in pattern.finditer(text):
+    if not any(count): # outside brackets
+      saved.append(text[last:m.start()])
+    kind, is_close = divmod(brackets.index(m.group()), 2)
+    count[kind] += -1 if is_close else 1
+    if count[kind] < 0: # unbalanced bracket
+      count[kind] = 0
+    last = m.end()
+  if not any(count):
+    saved.append(text[last:])
+  return ''.join(saved)
+
+def read_page(body):
+  # decodes the body of a crawled page, with accents stripped from its
+  # characters (as in: cafe instead of café), like the scripts always did
+
+  fstr = body.decode('utf8', errors='ignore')
+  if not fstr.isascii():
+    fstr = unicodedata.normalize('NFKD', fstr)
+    fstr = ''.join(c for c in fstr if not unicodedata.combining(c))
+  return fstr
+
+def extract_script(body):
+  # returns the (quote, character) rows of an episode script page
+  # only the script tables are parsed, the rest of the page is skipped
+
+  rows = []
+  soup = BeautifulSoup(read_page(body), PARSER,
+    parse_only=SoupStrainer('table', {'class':'wikitable'}))
+  for table in soup.find_all('table', {'class':'wikitable'}):
+    for tr in table.find_all('tr'):
+      th = tr.find('th')
+      td = tr.find('td')
+      if th is not None and td is not None:
+        owner = th.get_text().replace(':','').strip()
+        if owner != '':
+          descr = remove_text_inside_brackets(td.get_text()).replace('\n','').strip()
+          rows.append((descr, owner))
+  return rows
+
+def extract_synopsis(body):
+  # returns the (synopsis, episode title) row of an episode page
+  # (or no rows, if the page has no synopsis)
+
+  soup = BeautifulSoup(read_page(body), PARSER)
+  th = soup.find('h1') # owner, title
+  synh = soup.find(string='Synopsis') # synopsis section
+  td = synh.find_next('p') if synh is not None else None
+  if th is not None and td is not None:
+    owner = th.get_text()
+    if owner != '':
+      return [(td.get_text().replace('\n','').strip(), owner)]
+  return []
+
+workerarchive = None # the archive opened by a worker process
+workerextract = None # the extract function of a worker process
+
+def init_worker(archivename, extract):
+  # opens the archive once per worker process
+
+  global workerarchive, workerextract
+  workerarchive = PageStore(archivename, readonly=True)
+  workerextract = extract
+
+def extract_page(key):
+  # runs the worker's extract on the page of key
+
+  return workerextract(workerarchive.get(key))
+
+def extract_pages(archivename, keys, extract, workers=None, chunksize=4):
+  # runs extract(body) on the pages of keys in the archive archivename
+  # in worker processes, which read the pages themselves, so only the
+  # keys and the rows are passed between the processes
+  # yields (key, rows) per key, in the order of keys, as soon as the
+  # rows of that key are in
+  # workers: number of worker processes (default: one per core)
+  #   with workers=1, the pages are extracted in this process
+
+  keys = list(keys)
+  if workers == 1:
+    archive = PageStore(archivename, readonly=True)
+    for key in keys:
+      yield key, extract(archive.get(key))
+    archive.close()
+    return
+  with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+    initargs=(archivename, extract)) as executor:
+    for key, rows in zip(keys, executor.map(extract_page, keys,
+      chunksize=chunksize)):
+      yield key, rows
+
+def ingest(db, archivename, pages, extract, workers=None, checkpoint=10,
+  reload=False):
+  # extracts the pages that are new or changed since the last run
+  # and replaces their rows in the db, see DBHelper.replace_sources
+  # archivename: the PageStore archive the pages were crawled into
+  # pages: list of (source, key), source being the name the rows of
+  #   the page are kept under in the db (e.g. the episode title), key
+  #   the key of the page in the archive (e.g. 'script/<title>')
+  # db: DBHelper to write to (after setup), or None for a dry run
+  # checkpoint: number of pages written per transaction. an interrupted
+  #   run loses at most the pages since the last checkpoint, and the
+  #   next run resumes from there
+  # reload: if True, extract all pages again, not only changed ones
+  # yields (source, rows) for each page extracted
+  # on an empty db (or with reload), all pages are loaded at once with
+  # DBHelper.bulk_load instead, in a single transaction without
+  # checkpoints, and their rows are yielded when the load is done
+  # rows from before the manifest (without a source) that were extracted
+  # again are removed at the end, see DBHelper.drop_unsourced_duplicates
+  # whether a page changed is told by the hash the archive keeps of it,
+  # so unchanged pages are not even read
+
+  archive = PageStore(archivename, readonly=True)
+  manifest = db.get_manifest() if db is not None else {}
+  todo = []
+  for source, key in pages:
+    meta = archive.meta(key)
+    if meta is not None:
+      content_hash = meta['hash']
+      if (reload or source not in manifest or
+        manifest[source][0] != content_hash):
+        todo.append((source, key, content_hash))
+  archive.close()
+  print('{0} of {1} pages are new or changed'.format(len(todo), len(pages)))
+
+  extracted = ((source, content_hash, rows)
+    for (source, key, content_hash), (_, rows) in zip(todo,
+    extract_pages(archivename, [t[1] for t in todo], extract,
+    workers=workers)))
+  if db is not None and (reload or len(manifest) == 0):
+    loaded = []
+    def record():
+      for page in extracted:
+        loaded.append(page)
+        yield page
+    db.bulk_load(record())
+    for source, content_hash, rows in loaded:
+      yield source, rows
+  else:
+    batch = []
+    for source, content_hash, rows in extracted:
+      batch.append((source, content_hash, rows))
+      if db is not None and len(batch) >= checkpoint:
+        db.replace_sources(batch)
+        batch = []
+      yield source, rows
+    if db is not None and batch:
+      db.replace_sources(batch)
+  if db is not None:
+    removed = db.drop_unsourced_duplicates()
+    if removed > 0:
+      print('removed {0} rows extracted before the manifest'.format(removed))
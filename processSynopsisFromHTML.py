@@ -1,45 +1,25 @@
-
-import os.path
-from bs4 import BeautifulSoup
+import time
 from dbhelper import DBHelper
-import unicodedata
+from extractFromHTML import ingest, extract_synopsis
 
 # from a downloaded web page of an episode's information
 # go through the file and extract the summary information
 # then append it to the database
+# the pages are read from the archive EpSpider crawled them into, and
+# parsed in parallel, see extractFromHTML
+# only pages that are new or changed since the last run are extracted,
+# and an interrupted run resumes where it left off (see ingest)
 
 filename = 'titlesPROC.txt'
+archivename = 'pages.archive' # the PageStore EpSpider crawled into
+# (pages downloaded as loose files before can be added to it with
+#  PageStore(archivename).importFiles('summary/', './episodes_summaries'))
 dbname = 'SouthParkEpisodesSummariesDB.sqlite'
 writeToDB = True # false for testing, true for actual writing to DB
+workers = None # processes to parse pages with, None for one per core
+checkpoint = 10 # pages written to the db per transaction
+reload = False # true to extract all pages again, in one bulk load
 
-def remove_text_inside_brackets(text, brackets="()[]"):
-    count = [0] * (len(brackets) // 2) # count open/close brackets
-    saved_chars = []
-    for character in text:
-        for i, b in enumerate(brackets):
-            if character == b: # found bracket
-                kind, is_close = divmod(i, 2)
-                count[kind] += (-1)**is_close # `+1`: open, `-1`: close
-                if count[kind] < 0: # unbalanced bracket
-                    count[kind] = 0
-                break
-        else: # character is not a bracket
-            if not any(count): # outside brackets
-                saved_chars.append(character)
-    return ''.join(saved_chars)
-
-if writeToDB:
-  db = DBHelper(dbname=dbname)
-  db.setup()
-
-titles = []
-with open(filename, 'r') as f:
-  for line in f:
-    titles.append('./episodes_summaries/{0}'.format(line.replace('\n',''))) 
-
-s = 0
-
-l = len(titles)
 dbprelim = {}
 
 def add_to_dict(dic, key, val):
@@ -47,38 +27,36 @@ def add_to_dict(dic, key, val):
     dic[key] = []
   dic[key].append(val)
 
-for ti in range(s,l):
-  t = titles[ti]
-  print(ti,t)
-  if os.path.isfile(t):
-    print('processing: {0}'.format(t))
-    with open(t, encoding='utf8') as f:
-      fstr = f.read()
-      soup = BeautifulSoup(fstr, 'html.parser')
-      th = soup.find('h1') # owner, title
-      synh = soup.find(text='Synopsis') # synopsis section
-      if synh is not None: td = synh.findNext('p')
-      if th is not None and td is not None:
-        owner = th.get_text()
-        if owner is not u'':
-          descr = td.get_text().replace('\n','').strip()
-          #print(owner, descr)
-          add_to_dict(dbprelim, owner, descr)
-
-print([k for k in dbprelim])
-
-if writeToDB:
-  for owner in dbprelim:
-    if owner is not u'':
-      print('working on summary of {0}'.format(owner))
-      for descr in dbprelim[owner]:
-        try:
-          db.add_item(descr,owner)
-        except Exception as e:
-          print(e)
-          pass
-
-  for owner in dbprelim:
-    print('summary of {0}'.format(owner))
-    descr = db.get_items(owner)
-    print(descr)
\ No newline at end of file
+if __name__ == '__main__':
+  starttime = time.time()
+
+  if writeToDB:
+    db = DBHelper(dbname=dbname)
+    db.setup()
+
+  titles = []
+  with open(filename, 'r') as f:
+    for line in f:
+      title = line.replace('\n','')
+      titles.append((title, 'summary/{0}'.format(title)))
+
+  extracted = 0
+  for title, rows in ingest(db if writeToDB else None, archivename, titles,
+    extract_synopsis, workers=workers, checkpoint=checkpoint, reload=reload):
+    print('processed: {0}'.format(title))
+    for descr, owner in rows:
+      add_to_dict(dbprelim, owner, descr)
+    extracted += len(rows)
+  looptime = time.time() - starttime
+  print('extracted {0} rows in {1:.2f}s, {2:.0f} rows/sec'.format(
+    extracted, looptime, extracted / max(looptime, 1e-9)))
+
+  print([k for k in dbprelim])
+
+  if writeToDB:
+    for owner in dbprelim:
+      print('summary of {0}'.format(owner))
+      descr = db.get_items(owner)
+      print(descr)
+
+  print('total time: {0:.2f}s'.format(time.time() - starttime))